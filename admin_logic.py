@@ -1,137 +1,267 @@
-import json
+import csv
 from datetime import datetime
 from linebot.models import TextSendMessage
+from explanation_cache import explanation_cache
+from registry import get_registry
+from outbound import outbound_report
+from llm_gateway import gateway
+from entitlements import parse_window
+from analytics import results_analytics
 
-WHITELIST_FILE = "whitelist.json"
-PENDING_FILE = "pending_register.json"
 DEVELOPER_ID = "shaintane"
 
-def load_json(path):
+def is_admin(user_id):
+    return user_id == DEVELOPER_ID
+
+def reply(ctx, text):
+    ctx.line_bot_api.push_message(ctx.user_id, TextSendMessage(text=text))
+
+# 模擬新使用者進入測試（限開發者）
+def start_registration(ctx):
+    welcome = (
+        "👋 歡迎加入國考輔導系統！\n"
+        "請依下列格式輸入以完成註冊：\n\n"
+        "格式：學校 姓名 學號 起始日 結束日\n"
+        "範例：國立醫學大學 王小明 123456\n"
+        "2025-06-01 2025-09-30"
+    )
+    reply(ctx, welcome)
+    ctx.registration_buffer[ctx.user_id] = "awaiting_info"
+
+# 使用者註冊輸入資訊寫入待審核名單
+def submit_registration(ctx):
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        if len(ctx.args) != 5:
+            raise ValueError
+        school, name, student_id, start_date, end_date = ctx.args
+        entry = {
+            "school": school,
+            "name": name,
+            "student_id": student_id,
+            "start_date": start_date,
+            "end_date": end_date,
+            "line_id": ctx.user_id
+        }
+        try:
+            parse_window(entry)
+        except ValueError:
+            reply(ctx, "⚠️ 日期格式錯誤，請使用 YYYY-MM-DD")
+            return
+        get_registry().put("pending", entry)
+        del ctx.registration_buffer[ctx.user_id]
+        reply(ctx, "✅ 資料已送出，請等待管理者審核。")
     except:
-        return {}
+        reply(ctx, "⚠️ 請輸入正確格式：學校 姓名 學號 起始日 結束日")
 
-def save_json(path, data):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+# ✅ admin 功能（開發者）
+def approve(ctx):
+    entry = get_registry().approve(ctx.args[1])
+    if entry:
+        reply(ctx, f"✅ 已審核 {entry['name']} 成功加入白名單。")
+        ctx.line_bot_api.push_message(entry["line_id"], TextSendMessage(text="✅ 你的帳號已成功通過審核，可開始使用測驗系統！"))
+    else:
+        reply(ctx, "⚠️ 查無此學號或 LINE ID，請確認是否正確。")
 
-def is_admin(user_id):
-    return user_id == DEVELOPER_ID
+APPROVED_NOTICE = "✅ 你的帳號已成功通過審核，可開始使用測驗系統！"
+REPORT_MAX_NAMES = 50
+IMPORT_FIELDS = ("school", "name", "student_id", "start_date", "end_date", "line_id")
+
+def _approve_report(approved, missing, failed=()):
+    lines = [f"✅ 已審核 {len(approved)} 位加入白名單。"]
+    # LINE 單則訊息上限 5000 字，名單過長時只列前 REPORT_MAX_NAMES 筆
+    if approved:
+        names = [entry.get("name", entry["line_id"]) for entry in approved[:REPORT_MAX_NAMES]]
+        lines.append("、".join(names) + (" 等" if len(approved) > REPORT_MAX_NAMES else ""))
+    if missing:
+        lines.append(f"⚠️ 查無 {len(missing)} 筆：{'、'.join(missing[:REPORT_MAX_NAMES])}")
+    if failed:
+        lines.append(f"⚠️ 通知送出失敗 {len(failed)} 位")
+    return "\n".join(lines)
+
+# 批次審核：approve all 或 approve id1 id2 ...；一次交易寫入，通知以 multicast 送出
+def approve_batch(ctx, targets):
+    approved, missing = get_registry().approve_many(targets)
+    failed = []
+    if approved:
+        # 名單已寫入，通知失敗只列入報告，不影響審核結果
+        failed = ctx.line_bot_api.multicast([entry["line_id"] for entry in approved], TextSendMessage(text=APPROVED_NOTICE))
+    reply(ctx, _approve_report(approved, missing, failed))
 
-def handle_admin_commands(user_input, user_id, line_bot_api, registration_buffer):
-    user_input = user_input.strip()
-
-    # 模擬新使用者進入測試（限開發者）
-    if user_input == "測試" and user_id == DEVELOPER_ID:
-        welcome = (
-            "👋 歡迎加入國考輔導系統！\n"
-            "請依下列格式輸入以完成註冊：\n\n"
-            "格式：學校 姓名 學號 起始日 結束日\n"
-            "範例：國立醫學大學 王小明 123456\n"
-            "2025-06-01 2025-09-30"
-        )
-        line_bot_api.push_message(user_id, TextSendMessage(text=welcome))
-        registration_buffer[user_id] = "awaiting_info"
-        return True
-
-    # 使用者註冊輸入資訊寫入 pending_register.json
-    if user_id in registration_buffer:
+def approve_all(ctx):
+    pending = get_registry().all("pending")
+    if not pending:
+        reply(ctx, "📋 目前無待審核資料。")
+        return
+    approve_batch(ctx, [entry["line_id"] for entry in pending])
+
+def approve_list(ctx):
+    approve_batch(ctx, ctx.args[1:])
+
+# 批次匯入白名單：第一行為 import，其後每行一筆 學校,姓名,學號,起始日,結束日,LINE_ID（逗號或 Tab 分隔）
+def import_entries(ctx):
+    rows = [line for line in ctx.text.splitlines()[1:] if line.strip()]
+    if not rows:
+        reply(ctx, "⚠️ 請在 import 下一行起貼上資料：學校,姓名,學號,起始日,結束日,LINE_ID")
+        return
+    entries, errors = [], []
+    for lineno, row in enumerate(csv.reader(rows, delimiter="\t" if "\t" in rows[0] else ","), 2):
+        row = [field.strip() for field in row]
+        if row and row[2:3] in (["student_id"], ["學號"]):
+            continue
+        if len(row) != len(IMPORT_FIELDS):
+            errors.append(f"第 {lineno} 行欄位數 {len(row)}")
+            continue
+        entry = dict(zip(IMPORT_FIELDS, row))
+        if not entry["line_id"] or not entry["student_id"]:
+            # 缺 LINE ID 無法寫入名單，缺學號無法以學號審核或刪除
+            errors.append(f"第 {lineno} 行{'缺少 LINE ID' if not entry['line_id'] else '缺少學號'}")
+            continue
         try:
-            parts = user_input.strip().split()
-            if len(parts) != 5:
-                raise ValueError
-            school, name, student_id, start_date, end_date = parts
-            data = load_json(PENDING_FILE)
-            data[user_id] = {
-                "school": school,
-                "name": name,
-                "student_id": student_id,
-                "start_date": start_date,
-                "end_date": end_date,
-                "line_id": user_id
-            }
-            save_json(PENDING_FILE, data)
-            del registration_buffer[user_id]
-            line_bot_api.push_message(user_id, TextSendMessage(text="✅ 資料已送出，請等待管理者審核。"))
-        except:
-            line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 請輸入正確格式：學校 姓名 學號 起始日 結束日"))
-        return True
-
-    # ✅ admin 功能（開發者）
-    if is_admin(user_id):
-        parts = user_input.strip().split()
-
-        if user_input.startswith("approve ") and len(parts) == 2:
-            target = parts[1]
-            pending = load_json(PENDING_FILE)
-            key = None
-            for k, v in pending.items():
-                if v.get("line_id") == target or v.get("student_id") == target:
-                    key = k
-                    break
-            if key:
-                entry = pending.pop(key)
-                whitelist = load_json(WHITELIST_FILE)
-                whitelist[entry["line_id"]] = entry
-                save_json(WHITELIST_FILE, whitelist)
-                save_json(PENDING_FILE, pending)
-                line_bot_api.push_message(user_id, TextSendMessage(text=f"✅ 已審核 {entry['name']} 成功加入白名單。"))
-                line_bot_api.push_message(entry["line_id"], TextSendMessage(text="✅ 你的帳號已成功通過審核，可開始使用測驗系統！"))
-            else:
-                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 查無此學號或 LINE ID，請確認是否正確。"))
-            return True
-
-        if user_input.startswith("input ") and len(parts) == 7:
-            _, school, name, student_id, start_date, end_date, target_line = parts
-            whitelist = load_json(WHITELIST_FILE)
-            whitelist[target_line] = {
-                "school": school,
-                "name": name,
-                "student_id": student_id,
-                "start_date": start_date,
-                "end_date": end_date,
-                "line_id": target_line
-            }
-            save_json(WHITELIST_FILE, whitelist)
-            line_bot_api.push_message(user_id, TextSendMessage(text=f"✅ 已手動新增 {name} 至白名單。"))
-            return True
-
-        if user_input.startswith("delet ") and len(parts) == 2:
-            target = parts[1]
-            data = load_json(WHITELIST_FILE)
-            key = None
-            for k, v in data.items():
-                if v.get("line_id") == target or v.get("student_id") == target:
-                    key = k
-                    break
-            if key:
-                removed = data.pop(key)
-                save_json(WHITELIST_FILE, data)
-                line_bot_api.push_message(user_id, TextSendMessage(text=f"🗑️ 已移除 {removed['name']}"))
-            else:
-                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 查無此學號或 LINE ID。"))
-            return True
-
-        if user_input == "show whitelist":
-            whitelist = load_json(WHITELIST_FILE)
-            if not whitelist:
-                msg = "📋 目前白名單為空。"
-            else:
-                msg = "📋 白名單名單：\n" + "\n".join(
-                    [f"{v['name']} ({v['student_id']}) {v['start_date']}~{v['end_date']}" for v in whitelist.values()])
-            line_bot_api.push_message(user_id, TextSendMessage(text=msg))
-            return True
-
-        if user_input == "show pending":
-            pending = load_json(PENDING_FILE)
-            if not pending:
-                msg = "📋 目前無待審核資料。"
-            else:
-                msg = "🕐 待審核清單：\n" + "\n".join(
-                    [f"{v['name']} ({v['student_id']}) {v['start_date']}~{v['end_date']}" for v in pending.values()])
-            line_bot_api.push_message(user_id, TextSendMessage(text=msg))
-            return True
-
-    return False
+            parse_window(entry)
+        except ValueError:
+            errors.append(f"第 {lineno} 行日期格式錯誤")
+            continue
+        entries.append(entry)
+    get_registry().put_many("whitelist", entries)
+    text = f"✅ 已匯入 {len(entries)} 筆至白名單。"
+    if errors:
+        text += f"\n⚠️ 略過 {len(errors)} 行：\n" + "\n".join(errors)
+    reply(ctx, text)
+
+def input_entry(ctx):
+    _, school, name, student_id, start_date, end_date, target_line = ctx.args
+    entry = {
+        "school": school,
+        "name": name,
+        "student_id": student_id,
+        "start_date": start_date,
+        "end_date": end_date,
+        "line_id": target_line
+    }
+    try:
+        parse_window(entry)
+    except ValueError:
+        reply(ctx, "⚠️ 日期格式錯誤，請使用 YYYY-MM-DD")
+        return
+    get_registry().put("whitelist", entry)
+    reply(ctx, f"✅ 已手動新增 {name} 至白名單。")
+
+def delete_entry(ctx):
+    removed = get_registry().remove("whitelist", ctx.args[1])
+    if removed:
+        reply(ctx, f"🗑️ 已移除 {removed['name']}")
+    else:
+        reply(ctx, "⚠️ 查無此學號或 LINE ID。")
+
+def show_whitelist(ctx):
+    whitelist = get_registry().all("whitelist")
+    if not whitelist:
+        msg = "📋 目前白名單為空。"
+    else:
+        msg = "📋 白名單名單：\n" + "\n".join(
+            [f"{v['name']} ({v['student_id']}) {v['start_date']}~{v['end_date']}" for v in whitelist])
+    reply(ctx, msg)
+
+def show_pending(ctx):
+    pending = get_registry().all("pending")
+    if not pending:
+        msg = "📋 目前無待審核資料。"
+    else:
+        msg = "🕐 待審核清單：\n" + "\n".join(
+            [f"{v['name']} ({v['student_id']}) {v['start_date']}~{v['end_date']}" for v in pending])
+    reply(ctx, msg)
+
+def clear_explain(ctx):
+    repo = ctx.args[2]
+    removed = explanation_cache.invalidate_repo(repo)
+    reply(ctx, f"🧹 已清除 {repo} 的解析快取 {removed} 筆。")
+
+def explain_stats(ctx):
+    s = explanation_cache.report()
+    reply(ctx, (
+        "📊 解析快取統計：\n"
+        f"記憶體命中 {s['memory_hits']}、磁碟命中 {s['disk_hits']}、未命中 {s['misses']}\n"
+        f"命中率 {s['hit_rate']}%，記憶體筆數 {s['memory_items']}，淘汰 {s['evictions']}"
+    ))
+
+def session_stats(ctx):
+    s = ctx.user_sessions.memory_report()
+    # 共用後端的 session 由 TTL 自動過期，改顯示跨 worker 的版本衝突次數
+    tail = f"版本衝突 {s['conflicts']} 次" if "conflicts" in s else f"已淘汰 {s['evicted']} 筆"
+    reply(ctx, (
+        "🧠 測驗 session 記憶體：\n"
+        f"共 {s['sessions']} 筆（作答中 {s['active']}），約 {s['bytes']} bytes\n"
+        f"平均每筆 {s['bytes_per_session']} bytes，{tail}"
+    ))
+
+def send_stats(ctx):
+    s = outbound_report()
+    reply(ctx, (
+        "📨 訊息傳送統計：\n"
+        f"共 {s['messages']} 則，reply {s['reply_calls']} 次、push {s['push_calls']} 次、multicast {s['multicast_calls']} 次\n"
+        f"節省 push {s['pushes_saved']} 次，重試 {s['retries']} 次，失敗 {s['failures']} 次"
+    ))
+
+def llm_stats(ctx):
+    s = gateway.report()
+    reply(ctx, (
+        "🤖 OpenAI 呼叫統計：\n"
+        f"呼叫 {s['calls']} 次、失敗 {s['failures']} 次、合併 {s['coalesced']} 次，平均排隊 {s['avg_queue_wait_ms']} ms\n"
+        f"限流拒絕 {s['rate_limited']}、忙碌拒絕 {s['busy']}、斷路拒絕 {s['circuit_open']}\n"
+        f"斷路器狀態 {s['breaker_state']}，累計跳脫 {s['breaker_trips']} 次"
+    ))
+
+def subject_stats(ctx):
+    # 科目可用全名、別名或 repo 名稱
+    from exam_logic import SUBJECTS, ALIAS
+    name = ctx.text[len("stats"):].strip()
+    repo = SUBJECTS.get(ALIAS.get(name, name), name)
+    s = results_analytics.subject_report(repo)
+    if not s:
+        reply(ctx, f"📋 {name} 尚無作答紀錄。")
+        return
+    lines = [
+        f"📈 {s['subject']} 作答統計：",
+        f"測驗 {s['exams']} 次、學生 {s['students']} 位、作答 {s['answers']} 題，正確率 {s['correct_rate']}%",
+        "",
+        "最常答錯的題目："
+    ]
+    for q in s["hardest"]:
+        rate = round(q["correct"] / q["attempts"] * 100, 1)
+        choices = " ".join(f"{letter}{n}" for letter, n in zip("ABCD", q["choices"]))
+        lines.append(f"・{q['text']}… 正確率 {rate}%（{q['attempts']} 次，正解 {q['answer']}；{choices}）")
+    reply(ctx, "\n".join(lines))
+
+def student_history(ctx):
+    target = ctx.args[1]
+    entry = get_registry().find("whitelist", target)
+    line_id = entry["line_id"] if entry else target
+    history = results_analytics.student_history(line_id)
+    if not history:
+        reply(ctx, f"📋 {target} 尚無作答紀錄。")
+        return
+    lines = [f"🗂️ {entry['name'] if entry else target} 作答紀錄："]
+    for repo, h in history.items():
+        rate = round(h["correct"] / h["answers"] * 100, 1) if h["answers"] else 0.0
+        recent = "、".join(f"{score:g}" for score in h["recent"])
+        lines.append(f"{repo}：測驗 {h['exams']} 次，正確率 {rate}%，最近 {recent}")
+    reply(ctx, "\n".join(lines))
+
+def register_routes(router):
+    router.command("測試", start_registration, admin_only=True, exact=True, before_registration=True)
+    router.registration(submit_registration)
+    router.command("approve ", approve, admin_only=True, parts=2)
+    router.command("approve ", approve_list, admin_only=True)
+    router.command("approve all", approve_all, admin_only=True, exact=True)
+    router.command("import", import_entries, admin_only=True)
+    router.command("input ", input_entry, admin_only=True, parts=7)
+    router.command("delet ", delete_entry, admin_only=True, parts=2)
+    router.command("show whitelist", show_whitelist, admin_only=True, exact=True)
+    router.command("show pending", show_pending, admin_only=True, exact=True)
+    router.command("clear explain ", clear_explain, admin_only=True, parts=3)
+    router.command("explain stats", explain_stats, admin_only=True, exact=True)
+    router.command("session stats", session_stats, admin_only=True, exact=True)
+    router.command("send stats", send_stats, admin_only=True, exact=True)
+    router.command("llm stats", llm_stats, admin_only=True, exact=True)
+    router.command("stats ", subject_stats, admin_only=True)
+    router.command("history ", student_history, admin_only=True, parts=2)
@@ -0,0 +1,221 @@
+import atexit
+import fcntl
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+import time
+from metrics import inc
+
+RESULTS_LOG_DIR = os.getenv("RESULTS_LOG_DIR", "results_log")
+RESULTS_LOG_MAX_BYTES = int(os.getenv("RESULTS_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+ANALYTICS_CHECKPOINT_EVERY = int(os.getenv("ANALYTICS_CHECKPOINT_EVERY", "100"))
+# checkpoint 之前已讀完的分段保留幾個，其餘刪除；保留給稍微落後的 worker 繼續讀取
+RESULTS_LOG_KEEP_SEGMENTS = int(os.getenv("RESULTS_LOG_KEEP_SEGMENTS", "2"))
+STUDENT_RECENT_SCORES = 10
+LETTERS = "ABCD"
+
+def question_id(question):
+    # 以題目文字定址，題庫重新排序後仍對應同一題
+    return hashlib.sha1(question["題目"].encode("utf-8")).hexdigest()[:12]
+
+class ResultsAnalytics:
+    # 每份完成的測驗追加一行到分段輪替的 results log（results.000001.jsonl ...）
+    # 統計一律由 log 增量套用：各 worker 從自己的讀取位置往後追，因此也包含其他 worker 寫入的結果
+    # 定期把統計與讀取位置寫成 checkpoint，重啟後只需重播 checkpoint 之後的紀錄
+    def __init__(self, directory=RESULTS_LOG_DIR, max_bytes=RESULTS_LOG_MAX_BYTES, checkpoint_every=ANALYTICS_CHECKPOINT_EVERY,
+                 keep_segments=RESULTS_LOG_KEEP_SEGMENTS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.checkpoint_every = checkpoint_every
+        self.keep_segments = keep_segments
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.write_seq = 1
+        self.reset()
+
+    def reset(self):
+        self.subjects = {}
+        self.questions = {}
+        self.students = {}
+        self.position = [1, 0]
+        self.since_checkpoint = 0
+
+    def _segment(self, seq):
+        return os.path.join(self.directory, f"results.{seq:06d}.jsonl")
+
+    def _checkpoint_path(self):
+        return os.path.join(self.directory, "aggregates.json")
+
+    def _segments(self):
+        return sorted(int(m.group(1)) for m in (re.match(r"results\.(\d+)\.jsonl$", n) for n in os.listdir(self.directory)) if m)
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(self._checkpoint_path(), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.subjects, self.questions, self.students = data["subjects"], data["questions"], data["students"]
+            self.position = data["position"]
+        except (OSError, ValueError, KeyError):
+            self.reset()
+        self.write_seq = max(self._segments() + [self.position[0]])
+
+    def record(self, user_id, session, correct_letters):
+        # correct_letters：每題正解字母，順序同 session.indices
+        questions = [session.question(pos) for pos in range(session.size)]
+        line = json.dumps({
+            "ts": int(time.time()),
+            "user": user_id,
+            "repo": session.repo,
+            "subject": session.subject,
+            "q": [question_id(q) for q in questions],
+            "t": [q["題目"][:30] for q in questions],
+            "a": "".join(session.answer(pos) or "-" for pos in range(session.size)),
+            "c": "".join(correct_letters)
+        }, ensure_ascii=False, separators=(",", ":")) + "\n"
+        with self.lock:
+            self._ensure_loaded()
+            self._append(line.encode("utf-8"))
+            self._catch_up()
+        inc("results_logged_total", subject=session.repo)
+
+    def _append(self, data):
+        lock_path = os.path.join(self.directory, ".lock")
+        with open(lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # 其他 worker 可能已換到下一段
+                while os.path.exists(self._segment(self.write_seq + 1)):
+                    self.write_seq += 1
+                path = self._segment(self.write_seq)
+                if os.path.exists(path) and os.path.getsize(path) >= self.max_bytes:
+                    self.write_seq += 1
+                    path = self._segment(self.write_seq)
+                with open(path, "ab") as f:
+                    f.write(data)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _catch_up(self):
+        seq, offset = self.position
+        if not os.path.exists(self._segment(seq)):
+            seqs = self._segments()
+            if seqs and seqs[0] > seq:
+                # 尚未讀取的分段已被其他 worker 的 checkpoint 清掉，改從最新的 checkpoint 接續
+                self._reload(seqs[0])
+                seq, offset = self.position
+        while True:
+            try:
+                with open(self._segment(seq), "rb") as f:
+                    f.seek(offset)
+                    chunk = f.read()
+            except FileNotFoundError:
+                chunk = b""
+            # 只套用完整的行，寫到一半的留待下次
+            end = chunk.rfind(b"\n") + 1
+            for raw in chunk[:end].splitlines():
+                try:
+                    self._apply(json.loads(raw))
+                except (ValueError, KeyError):
+                    continue
+            offset += end
+            if end < len(chunk) or not os.path.exists(self._segment(seq + 1)):
+                break
+            seq, offset = seq + 1, 0
+        self.position = [seq, offset]
+        if self.since_checkpoint >= self.checkpoint_every:
+            self._checkpoint()
+
+    def _reload(self, oldest):
+        self.reset()
+        self.loaded = False
+        self._ensure_loaded()
+        if self.position[0] < oldest:
+            print(f"⚠️ 成績紀錄分段 {self.position[0]:06d}~{oldest - 1:06d} 已刪除，統計略過這些紀錄")
+            self.position = [oldest, 0]
+
+    def _apply(self, rec):
+        repo = rec["repo"]
+        answers, correct = rec["a"], rec["c"]
+        right = sum(1 for a, c in zip(answers, correct) if a == c)
+        subject = self.subjects.setdefault(repo, {"subject": rec["subject"], "exams": 0, "answers": 0, "correct": 0, "students": 0})
+        subject["exams"] += 1
+        subject["answers"] += len(answers)
+        subject["correct"] += right
+        bank = self.questions.setdefault(repo, {})
+        for qid, text, a, c in zip(rec["q"], rec["t"], answers, correct):
+            q = bank.setdefault(qid, {"text": text, "answer": c, "attempts": 0, "correct": 0, "choices": [0, 0, 0, 0]})
+            q["attempts"] += 1
+            q["correct"] += a == c
+            if a in LETTERS:
+                q["choices"][LETTERS.index(a)] += 1
+        history = self.students.setdefault(rec["user"], {})
+        if repo not in history:
+            subject["students"] += 1
+        h = history.setdefault(repo, {"exams": 0, "answers": 0, "correct": 0, "recent": []})
+        h["exams"] += 1
+        h["answers"] += len(answers)
+        h["correct"] += right
+        h["last"] = rec["ts"]
+        h["recent"] = (h["recent"] + [round(right / len(answers) * 100, 1) if answers else 0.0])[-STUDENT_RECENT_SCORES:]
+        self.since_checkpoint += 1
+
+    def _checkpoint(self):
+        path = self._checkpoint_path()
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({
+                "position": self.position,
+                "subjects": self.subjects,
+                "questions": self.questions,
+                "students": self.students
+            }, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, path)
+        self.since_checkpoint = 0
+        # checkpoint 已涵蓋目前讀取位置之前的分段，超過保留數的舊分段可刪除
+        for seq in self._segments():
+            if seq >= self.position[0] - self.keep_segments:
+                break
+            try:
+                os.remove(self._segment(seq))
+            except FileNotFoundError:
+                pass
+
+    def checkpoint(self):
+        with self.lock:
+            if not self.loaded:
+                return
+            # 先追上其他 worker 寫入的紀錄，避免以較舊的位置覆蓋 checkpoint
+            self._catch_up()
+            if self.since_checkpoint:
+                self._checkpoint()
+
+    def subject_report(self, repo, hardest=5):
+        # 讀取已累積的統計，耗時與測驗總數無關
+        with self.lock:
+            self._ensure_loaded()
+            self._catch_up()
+            subject = dict(self.subjects.get(repo) or {})
+            bank = self.questions.get(repo, {})
+            worst = heapq.nsmallest(hardest, bank.values(), key=lambda q: q["correct"] / q["attempts"])
+            worst = [dict(q, choices=list(q["choices"])) for q in worst]
+        if not subject:
+            return None
+        subject["correct_rate"] = round(subject["correct"] / subject["answers"] * 100, 1) if subject["answers"] else 0.0
+        subject["hardest"] = worst
+        return subject
+
+    def student_history(self, user_id):
+        with self.lock:
+            self._ensure_loaded()
+            self._catch_up()
+            return json.loads(json.dumps(self.students.get(user_id, {})))
+
+results_analytics = ResultsAnalytics()
+atexit.register(results_analytics.checkpoint)
@@ -1,19 +1,89 @@
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, request, abort, jsonify, Response
+from linebot import LineBotApi, WebhookHandler, WebhookParser
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
+import atexit
 import os
+import signal
+import sys
+import traceback
 from dotenv import load_dotenv
+from dispatcher import EventDispatcher, DispatchQueueFull
+from session_store import SessionStore, SharedSessionStore
+from shared_state import SharedDict, get_backend, is_shared
+from bank_cache import get_question_bank
+from outbound import Outbox, PooledHttpClient, outbound_report
+from explanation_cache import explanation_cache
+from startup import StartupTracker, get_openai_client, start_warm_up
+from dedup import deduplicator
+import metrics
 
 load_dotenv()
 
+class TimedWebhookParser(WebhookParser):
+    # 單獨量測驗簽與解析 webhook body 的耗時
+    def parse(self, body, signature, as_payload=False, use_raw_message=False):
+        with metrics.timed("signature"):
+            return super(TimedWebhookParser, self).parse(body, signature, as_payload=as_payload, use_raw_message=use_raw_message)
+
+startup = StartupTracker()
 app = Flask(__name__)
-line_bot_api = LineBotApi(os.getenv("CHANNEL_ACCESS_TOKEN"))
-handler = WebhookHandler(os.getenv("CHANNEL_SECRET"))
+with startup.phase("line_client"):
+    line_bot_api = LineBotApi(
+        os.getenv("CHANNEL_ACCESS_TOKEN"),
+        endpoint=os.getenv("LINE_API_ENDPOINT", LineBotApi.DEFAULT_API_ENDPOINT),
+        http_client=PooledHttpClient
+    )
+    handler = WebhookHandler(os.getenv("CHANNEL_SECRET"))
+    handler.parser = TimedWebhookParser(os.getenv("CHANNEL_SECRET"))
+with startup.phase("handlers_import"):
+    from handlers import process_message
+    from exam_logic import SUBJECTS
+    from registry import get_registry
+    from entitlements import get_entitlements, set_notifier
+
+# 初始化記憶結構；SHARED_STATE 設為 sqlite / redis 時改存共用後端，可執行多個 worker process
+user_sessions = SharedSessionStore(get_backend(), get_question_bank) if is_shared() else SessionStore()
+registration_buffer = SharedDict(get_backend(), "registration", ttl=int(os.getenv("REGISTRATION_TTL", str(24 * 60 * 60))))
+# worker 數由 Procfile 的 GUNICORN_WORKERS 決定（預設 1）；不使用平台自動設定的 WEB_CONCURRENCY
+if not is_shared() and int(os.getenv("GUNICORN_WORKERS", "1")) > 1:
+    # 各 worker 的 session 互不相通會讓學生作答跳題，直接拒絕啟動
+    raise RuntimeError("GUNICORN_WORKERS > 1 需設定 SHARED_STATE=sqlite 或 redis")
+
+# DISPATCH_MODE=async 時 /callback 驗簽後立即回 200，事件交給依 user_id 分片的 worker 處理
+DISPATCH_MODE = os.getenv("DISPATCH_MODE", "async").lower()
+dispatcher = None
+if DISPATCH_MODE == "async":
+    dispatcher = EventDispatcher(
+        workers=int(os.getenv("DISPATCH_WORKERS", "4")),
+        queue_size=int(os.getenv("DISPATCH_QUEUE_SIZE", "100")),
+        put_timeout=float(os.getenv("DISPATCH_PUT_TIMEOUT", "2"))
+    )
+    atexit.register(dispatcher.shutdown, float(os.getenv("DISPATCH_DRAIN_TIMEOUT", "25")))
+
+# 背景暖機：建立 OpenAI client、載入 registry、並行預載六科題庫
+set_notifier(lambda line_id, entry: line_bot_api.push_message(
+    line_id, TextSendMessage(text=f"⏰ 你的使用期間將於 {entry.get('end_date')} 結束，如需續用請聯絡管理者。")
+))
+start_warm_up(startup, SUBJECTS.values(), extra_steps=[("registry", get_registry), ("entitlements", get_entitlements)])
+
+def _runtime_gauges():
+    gauges = [("sessions", {}, len(user_sessions))]
+    gauges += metrics.stats_series("outbound_", outbound_report())
+    gauges += metrics.stats_series("explain_cache_", explanation_cache.report(), gauges=("memory_items", "hit_rate"))
+    if dispatcher:
+        gauges.append(("dispatch_queue_depth", {}, dispatcher.pending()))
+    return gauges
+
+metrics.register_collector(_runtime_gauges)
 
-# 初始化記憶結構
-user_sessions = {}
-registration_buffer = {}
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    return jsonify(startup.report()), (200 if startup.ready.is_set() else 503)
 
 @app.route("/callback", methods=["POST"])
 def callback():
@@ -22,32 +92,63 @@ def callback():
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
+        metrics.inc("webhook_rejected_total", reason="signature")
         abort(400)
+    except DispatchQueueFull:
+        # 背壓：佇列已滿時回 503，讓 LINE 稍後重送
+        metrics.inc("webhook_rejected_total", reason="queue_full")
+        abort(503)
     return "OK"
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
-    try:
-        from handlers import process_message
-        from openai import OpenAI
-        client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    # LINE 重送已處理過的事件時直接略過，避免重複作答或重複扣解析次數
+    if not deduplicator.first_delivery(event):
+        return
+    if dispatcher:
+        try:
+            dispatcher.submit(event.source.user_id, process_event, event)
+        except DispatchQueueFull:
+            deduplicator.forget(event)
+            raise
+    else:
+        process_event(event)
+
+def process_event(event):
+    # 以 LINE 的 webhookEventId 作為 correlation ID，串起同一事件的所有 log
+    with metrics.event_context(getattr(event, "webhook_event_id", None), user_id=event.source.user_id) as cid:
+        # 所有回覆經由 Outbox 合併送出，優先使用免費的 reply token
+        outbox = Outbox(line_bot_api, event.source.user_id, event.reply_token, event.timestamp / 1000)
+        try:
+            client = get_openai_client()
 
-        # 僅在 DEBUG_MODE == "true" 時顯示初始回覆
-        if os.getenv("DEBUG_MODE", "false").lower() == "true":
-            line_bot_api.reply_message(
+            # 僅在 DEBUG_MODE == "true" 時顯示初始回覆
+            if os.getenv("DEBUG_MODE", "false").lower() == "true":
+                outbox.reply_message(
+                    event.reply_token,
+                    TextSendMessage(text="✅ 收到訊息，系統正在處理中...")
+                )
+                outbox.flush()
+
+            # 處理邏輯訊息
+            process_message(event, outbox, client, user_sessions, registration_buffer)
+
+        except Exception as e:
+            # 發生錯誤時仍需回覆；錯誤細節只寫入 log，不回傳給使用者
+            metrics.inc("event_errors_total", error=type(e).__name__)
+            print(f"⚠️ 事件處理失敗 [{cid}]：{e}\n{traceback.format_exc()}")
+            outbox.reply_message(
                 event.reply_token,
-                TextSendMessage(text="✅ 收到訊息，系統正在處理中...")
+                TextSendMessage(text=f"⚠️ 系統錯誤，請稍後再試（代碼 {cid[:8]}）")
             )
+        finally:
+            outbox.flush()
 
-        # 處理邏輯訊息
-        process_message(event, line_bot_api, client, user_sessions, registration_buffer)
-
-    except Exception as e:
-        # 發生錯誤時仍需回覆
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"⚠️ 系統錯誤：{str(e)}")
-        )
+def _drain_and_exit(signum, frame):
+    if dispatcher:
+        dispatcher.shutdown(float(os.getenv("DISPATCH_DRAIN_TIMEOUT", "25")))
+    sys.exit(0)
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, _drain_and_exit)
     app.run(host="0.0.0.0", port=8080)
@@ -0,0 +1,145 @@
+import json
+import os
+import threading
+import time
+import requests
+from bank_compiler import CompiledBank, open_compiled
+from metrics import timed
+
+GITHUB_OWNER = "shaintane"
+GITHUB_API_URL = os.getenv("GITHUB_API_URL", "https://api.github.com")
+BANK_CACHE_TTL = int(os.getenv("BANK_CACHE_TTL", "600"))
+BANK_CACHE_RETRY = int(os.getenv("BANK_CACHE_RETRY", "60"))
+BANK_CACHE_DIR = os.getenv("BANK_CACHE_DIR", "bank_cache")
+
+# repo -> {"bank", "sha", "listing_etag", "raw_etag", "checked_at"}
+_entries = {}
+_lock = threading.Lock()
+_refreshing = set()
+_http = requests.Session()
+
+def _snapshot_path(repo):
+    return os.path.join(BANK_CACHE_DIR, f"{repo}.json")
+
+def _load_snapshot(repo):
+    try:
+        with open(_snapshot_path(repo), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+        if entry.get("bank"):
+            return entry
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _save_snapshot(repo, entry):
+    # 先寫暫存檔再 rename，避免讀到寫一半的快照
+    try:
+        os.makedirs(BANK_CACHE_DIR, exist_ok=True)
+        path = _snapshot_path(repo)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️ 題庫快照寫入失敗 {repo}：{e}")
+
+def _fetch(repo, entry):
+    # 以 ETag 重新驗證：304 不重新下載，也不計入 GitHub rate limit
+    entry = dict(entry or {})
+    headers = {}
+    if entry.get("listing_etag") and entry.get("bank"):
+        headers["If-None-Match"] = entry["listing_etag"]
+    api_url = f"{GITHUB_API_URL}/repos/{GITHUB_OWNER}/{repo}/contents"
+    res = _http.get(api_url, headers=headers, timeout=5)
+    if res.status_code == 304:
+        return entry
+    res.raise_for_status()
+    entry["listing_etag"] = res.headers.get("ETag")
+    for file in res.json():
+        if file["name"].startswith("question_bank_") and file["name"].endswith(".json"):
+            if entry.get("bank") and file.get("sha") and file["sha"] == entry.get("sha"):
+                return entry
+            headers = {}
+            if entry.get("raw_etag") and entry.get("bank"):
+                headers["If-None-Match"] = entry["raw_etag"]
+            raw = _http.get(file["download_url"], headers=headers, timeout=5)
+            if raw.status_code == 304:
+                entry["sha"] = file.get("sha")
+                return entry
+            raw.raise_for_status()
+            bank = raw.json()
+            if not bank:
+                raise ValueError("題庫內容為空")
+            entry.update(bank=bank, sha=file.get("sha"), raw_etag=raw.headers.get("ETag"))
+            return entry
+    raise ValueError("找不到 question_bank_*.json")
+
+def refresh(repo):
+    with _lock:
+        old = _entries.get(repo)
+    try:
+        entry = _fetch(repo, old)
+    except Exception as e:
+        print(f"⚠️ 題庫更新失敗 {repo}：{e}")
+        if old:
+            # 失敗時沿用舊資料，並延後下次檢查避免連續打 GitHub
+            with _lock:
+                old["checked_at"] = time.time() - BANK_CACHE_TTL + BANK_CACHE_RETRY
+        return old["bank"] if old else []
+    entry["checked_at"] = time.time()
+    changed = not old or entry.get("bank") is not old.get("bank")
+    with _lock:
+        _entries[repo] = entry
+    if changed or entry.get("listing_etag") != (old or {}).get("listing_etag"):
+        _save_snapshot(repo, entry)
+    return entry["bank"]
+
+def _refresh_in_background(repo):
+    with _lock:
+        if repo in _refreshing:
+            return
+        _refreshing.add(repo)
+
+    def run():
+        try:
+            refresh(repo)
+        finally:
+            with _lock:
+                _refreshing.discard(repo)
+
+    threading.Thread(target=run, name=f"bank-refresh-{repo}", daemon=True).start()
+
+def bank_version(repo, bank):
+    # [識別, 題數]：編譯檔以 mtime、GitHub 題庫以檔案 sha 識別；此 worker 不知道 sha 時識別為 None
+    if isinstance(bank, CompiledBank):
+        return [f"qbk:{bank.version()}", len(bank)]
+    with _lock:
+        entry = _entries.get(repo)
+    sha = entry.get("sha") if entry and entry.get("bank") is bank else None
+    return [sha, len(bank)]
+
+def same_bank_version(a, b):
+    # 題數不同，或兩邊都知道識別且不同，視為不同版本
+    return a[1] == b[1] and (a[0] is None or b[0] is None or a[0] == b[0])
+
+def get_question_bank(repo):
+    with timed("bank_load", subject=repo):
+        return _get_question_bank(repo)
+
+def _get_question_bank(repo):
+    # 有離線編譯好的題庫檔時優先使用 mmap 版本
+    compiled = open_compiled(repo)
+    if compiled is not None:
+        return compiled
+    with _lock:
+        entry = _entries.get(repo)
+        if entry is None:
+            entry = _load_snapshot(repo)
+            if entry:
+                _entries[repo] = entry
+    if entry is None:
+        # 記憶體與磁碟都沒有資料時才同步下載（僅冷啟動第一次）
+        return refresh(repo)
+    if time.time() - entry.get("checked_at", 0) > BANK_CACHE_TTL:
+        _refresh_in_background(repo)
+    return entry["bank"]
@@ -0,0 +1,158 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+
+BANK_COMPILED_DIR = os.getenv("BANK_COMPILED_DIR", "compiled_banks")
+MAGIC = b"QBNK"
+VERSION = 2
+HEADER = struct.Struct("<4sHHI")
+OFFSET = struct.Struct("<I")
+FIELD = struct.Struct("<I")
+ANSWER_CODES = {"A": 1, "B": 2, "C": 3, "D": 4}
+ANSWER_LETTERS = " ABCD"
+
+# 檔案格式：header、(題數+1) 個 uint32 位移索引、各題資料
+# 每題：1 byte 正解代碼 + 三個長度前綴欄位（預先排版的題目文字、圖片網址、原始題目 JSON）
+# 編譯檔存在時 bank_cache 直接使用，不再向 GitHub 檢查更新：題庫 repo 更新後須重新執行
+# python bank_compiler.py [repo ...]，各 worker 偵測到檔案 mtime 改變後會自動換用新版
+
+def compiled_path(repo):
+    return os.path.join(BANK_COMPILED_DIR, f"{repo}.qbk")
+
+def _field(text):
+    data = text.encode("utf-8")
+    return FIELD.pack(len(data)) + data
+
+def compile_bank(questions, repo, path=None):
+    from core_logic import normalize_answer
+    path = path or compiled_path(repo)
+    records = []
+    for n, q in enumerate(questions, 1):
+        code = ANSWER_CODES.get(normalize_answer(str(q.get("正解", ""))))
+        if code is None:
+            # 正解無法解析時整份題庫編譯失敗，避免作答一律被判錯
+            raise ValueError(f"{repo} 第 {n} 題正解無法解析：{q.get('正解')!r}")
+        image_url = f"https://raw.githubusercontent.com/shaintane/{repo}/main/{q['圖片連結']}" if q.get("圖片連結") else ""
+        body = f"{q['題目']}\n" + "\n".join(q['選項']) + (f"\n\n{image_url}" if image_url else "")
+        raw = json.dumps(q, ensure_ascii=False, separators=(",", ":"))
+        records.append(bytes([code]) + _field(body) + _field(image_url) + _field(raw))
+    offsets, pos = [], 0
+    for rec in records:
+        offsets.append(pos)
+        pos += len(rec)
+    offsets.append(pos)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, 0, len(records)))
+        f.write(b"".join(OFFSET.pack(o) for o in offsets))
+        f.writelines(records)
+    os.replace(tmp, path)
+    return len(records)
+
+class CompiledBank:
+    # 以 mmap 讀取：多個 worker 共用同一份 page cache，抽題時只讀取被抽到的題目
+    def __init__(self, path, repo=None):
+        self.path = path
+        self.repo = repo
+        with open(path, "rb") as f:
+            self.mtime = os.fstat(f.fileno()).st_mtime
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"不支援的題庫檔格式：{path}")
+        self.data_start = HEADER.size + OFFSET.size * (self.count + 1)
+
+    def close(self):
+        self.buf.close()
+
+    def _live(self):
+        # 已被新版本取代並關閉時改讀同一科目目前的映射（與共用 session 依 repo 重新取得題庫的行為一致）
+        if not self.buf.closed or self.repo is None:
+            return self
+        return open_compiled(self.repo) or self
+
+    def __len__(self):
+        return self._live().count
+
+    def version(self):
+        # 目前實際讀取的編譯檔 mtime；同一個檔案在各 worker 相同
+        return self._live().mtime
+
+    def _record(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        start = OFFSET.unpack_from(self.buf, HEADER.size + OFFSET.size * i)[0]
+        return self.data_start + start
+
+    def _fields(self, i):
+        pos = self._record(i) + 1
+        fields = []
+        for _ in range(3):
+            n = FIELD.unpack_from(self.buf, pos)[0]
+            pos += FIELD.size
+            fields.append(self.buf[pos:pos + n].decode("utf-8"))
+            pos += n
+        return fields
+
+    def answer(self, i):
+        bank = self._live()
+        return ANSWER_LETTERS[bank.buf[bank._record(i)]]
+
+    def render(self, i, index):
+        return f"第 {index+1} 題：{self._live()._fields(i)[0]}"
+
+    def image_url(self, i):
+        return self._live()._fields(i)[1]
+
+    def __getitem__(self, i):
+        return json.loads(self._live()._fields(i)[2])
+
+_opened = {}
+_opened_lock = threading.Lock()
+
+def open_compiled(repo):
+    # 編譯檔被重新產生（mtime 改變）時自動重新開啟
+    path = compiled_path(repo)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return None
+    with _opened_lock:
+        bank = _opened.get(repo)
+        if bank is None or bank.mtime != mtime:
+            old = bank
+            try:
+                bank = CompiledBank(path, repo)
+            except (OSError, ValueError) as e:
+                print(f"⚠️ 編譯題庫開啟失敗 {repo}：{e}")
+                return None
+            _opened[repo] = bank
+            if old is not None:
+                # 換用新版後關閉舊的映射，仍持有舊物件的 session 會改讀新版
+                old.close()
+        return bank
+
+if __name__ == "__main__":
+    # 用法：python bank_compiler.py [repo ...]（未指定時編譯所有科目）
+    import bank_cache
+    from exam_logic import SUBJECTS
+    repos = sys.argv[1:] or list(SUBJECTS.values())
+    failed = False
+    for repo in repos:
+        questions = bank_cache.refresh(repo)
+        if not questions:
+            print(f"⚠️ {repo} 題庫下載失敗")
+            failed = True
+            continue
+        try:
+            count = compile_bank(questions, repo)
+        except ValueError as e:
+            print(f"⚠️ {e}")
+            failed = True
+            continue
+        print(f"✅ {repo}：{count} 題 → {compiled_path(repo)}")
+    sys.exit(1 if failed else 0)
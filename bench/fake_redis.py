@@ -0,0 +1,147 @@
+import fnmatch
+import socketserver
+import threading
+import time
+
+# 本機 Redis 替身：實作 shared_state.RedisBackend 用到的 RESP 指令
+# GET / SET [NX] [PX] / DEL / MGET / SCAN / WATCH / UNWATCH / MULTI / EXEC / DISCARD / PING / SELECT / AUTH
+
+class FakeRedis:
+    def __init__(self, host="127.0.0.1", port=0):
+        self.data = {}
+        self.revisions = {}
+        self.lock = threading.RLock()
+        self.commands = 0
+        self.server = socketserver.ThreadingTCPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"redis://{host}:{self.server.server_address[1]}/0"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-redis", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _touch(self, key):
+        self.revisions[key] = self.revisions.get(key, 0) + 1
+
+    def _get(self, key):
+        item = self.data.get(key)
+        if item and item[1] and item[1] < time.time():
+            del self.data[key]
+            self._touch(key)
+            return None
+        return item[0] if item else None
+
+    def run(self, args):
+        name = args[0].upper()
+        with self.lock:
+            self.commands += 1
+            if name in (b"PING",):
+                return "PONG"
+            if name in (b"SELECT", b"AUTH"):
+                return "OK"
+            if name == b"GET":
+                return self._get(args[1])
+            if name == b"MGET":
+                return [self._get(k) for k in args[1:]]
+            if name == b"SET":
+                key, value, options = args[1], args[2], [a.upper() for a in args[3:]]
+                if b"NX" in options and self._get(key) is not None:
+                    return None
+                expires = None
+                if b"PX" in options:
+                    expires = time.time() + int(args[3 + options.index(b"PX") + 1]) / 1000
+                self.data[key] = (value, expires)
+                self._touch(key)
+                return "OK"
+            if name == b"DEL":
+                removed = 0
+                for key in args[1:]:
+                    if self._get(key) is not None:
+                        del self.data[key]
+                        self._touch(key)
+                        removed += 1
+                return removed
+            if name == b"SCAN":
+                pattern = args[args.index(b"MATCH") + 1].decode("utf-8") if b"MATCH" in args else "*"
+                keys = [k for k in list(self.data) if self._get(k) is not None and fnmatch.fnmatchcase(k.decode("utf-8"), pattern)]
+                return [b"0", keys]
+        return Exception(f"ERR unknown command '{name.decode('utf-8')}'")
+
+    def _handler(self):
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                watched = {}
+                queued = None
+                while True:
+                    args = self._read_command()
+                    if args is None:
+                        return
+                    name = args[0].upper()
+                    if name == b"WATCH":
+                        with fake.lock:
+                            for key in args[1:]:
+                                watched[key] = fake.revisions.get(key, 0)
+                        self._reply("OK")
+                    elif name == b"UNWATCH":
+                        watched.clear()
+                        self._reply("OK")
+                    elif name == b"MULTI":
+                        queued = []
+                        self._reply("OK")
+                    elif name == b"DISCARD":
+                        queued = None
+                        watched.clear()
+                        self._reply("OK")
+                    elif name == b"EXEC":
+                        with fake.lock:
+                            conflict = any(fake.revisions.get(k, 0) != v for k, v in watched.items())
+                            results = None if conflict else [fake.run(cmd) for cmd in queued or []]
+                        queued = None
+                        watched.clear()
+                        # WATCH 的 key 被改過時 EXEC 回傳 null array
+                        self.wfile.write(b"*-1\r\n" if results is None else self._encode(results))
+                    elif queued is not None:
+                        queued.append(args)
+                        self._reply("QUEUED")
+                    else:
+                        self._reply(fake.run(args))
+
+            def _read_command(self):
+                line = self.rfile.readline()
+                if not line:
+                    return None
+                count = int(line[1:-2])
+                args = []
+                for _ in range(count):
+                    size = int(self.rfile.readline()[1:-2])
+                    args.append(self.rfile.read(size + 2)[:-2])
+                return args
+
+            def _encode(self, value):
+                if value is None:
+                    return b"$-1\r\n"
+                if isinstance(value, Exception):
+                    return b"-%s\r\n" % str(value).encode("utf-8")
+                if isinstance(value, str):
+                    return b"+%s\r\n" % value.encode("utf-8")
+                if isinstance(value, int):
+                    return b":%d\r\n" % value
+                if isinstance(value, bytes):
+                    return b"$%d\r\n%s\r\n" % (len(value), value)
+                return b"*%d\r\n" % len(value) + b"".join(self._encode(v) for v in value)
+
+            def _reply(self, value):
+                self.wfile.write(self._encode(value))
+
+        return Handler
+
+if __name__ == "__main__":
+    server = FakeRedis(port=6379).start()
+    print(f"✅ fake redis listening on {server.url}")
+    threading.Event().wait()
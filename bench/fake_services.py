@@ -0,0 +1,127 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 本機替身：LINE Messaging API、OpenAI chat completions、GitHub contents / raw
+
+def make_bank(repo, size):
+    return [
+        {
+            "題目": f"{repo} 第 {i+1} 題：下列何者正確？",
+            "選項": ["A. 選項甲", "B. 選項乙", "C. 選項丙", "D. 選項丁"],
+            "正解": "ABCD"[i % 4],
+            "圖片連結": f"images/{i+1}.png" if i % 10 == 0 else ""
+        }
+        for i in range(size)
+    ]
+
+class FakeServices:
+    def __init__(self, host="127.0.0.1", port=0, openai_latency=0.5, bank_size=200):
+        self.openai_latency = openai_latency
+        self.bank_size = bank_size
+        self.banks = {}
+        self.calls = Counter()
+        self.messages = Counter()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://{host}:{self.server.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="fake-services", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+
+    def count(self, name, messages=0):
+        with self.lock:
+            self.calls[name] += 1
+            self.messages[name] += messages
+
+    def bank(self, repo):
+        with self.lock:
+            if repo not in self.banks:
+                self.banks[repo] = json.dumps(make_bank(repo, self.bank_size), ensure_ascii=False).encode("utf-8")
+            return self.banks[repo]
+
+    def report(self):
+        with self.lock:
+            return {"calls": dict(self.calls), "messages": dict(self.messages)}
+
+    def _handler(self):
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status, body=b"{}", headers=None):
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self):
+                n = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(n) or b"{}")
+
+            def do_GET(self):
+                m = re.fullmatch(r"/repos/([^/]+)/([^/]+)/contents", self.path)
+                if m:
+                    repo = m.group(2)
+                    etag = f'"listing-{repo}"'
+                    if self.headers.get("If-None-Match") == etag:
+                        services.count("github_contents_304")
+                        return self._send(304, b"")
+                    services.count("github_contents")
+                    listing = [{
+                        "name": f"question_bank_{repo}.json",
+                        "sha": f"sha-{repo}",
+                        "download_url": f"{services.url}/raw/{repo}/question_bank_{repo}.json"
+                    }]
+                    return self._send(200, json.dumps(listing).encode("utf-8"), {"ETag": etag})
+                m = re.fullmatch(r"/raw/([^/]+)/[^/]+\.json", self.path)
+                if m:
+                    services.count("github_raw")
+                    return self._send(200, services.bank(m.group(1)), {"ETag": f'"raw-{m.group(1)}"'})
+                self._send(404)
+
+            def do_POST(self):
+                body = self._body()
+                if self.path == "/v2/bot/message/reply":
+                    services.count("line_reply", len(body.get("messages", [])))
+                    return self._send(200)
+                if self.path == "/v2/bot/message/push":
+                    services.count("line_push", len(body.get("messages", [])))
+                    return self._send(200)
+                if self.path == "/v2/bot/message/multicast":
+                    services.count("line_multicast", len(body.get("messages", [])) * len(body.get("to", [])))
+                    return self._send(200)
+                if self.path.endswith("/chat/completions"):
+                    services.count("openai_chat")
+                    time.sleep(services.openai_latency)
+                    completion = {
+                        "id": "chatcmpl-bench",
+                        "object": "chat.completion",
+                        "created": int(time.time()),
+                        "model": body.get("model", "gpt-3.5-turbo"),
+                        "choices": [{
+                            "index": 0,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": "這是基準測試用的解析內容。"}
+                        }],
+                        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2}
+                    }
+                    return self._send(200, json.dumps(completion, ensure_ascii=False).encode("utf-8"))
+                self._send(404)
+
+        return Handler
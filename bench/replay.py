@@ -0,0 +1,279 @@
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fake_services import FakeServices
+from fake_redis import FakeRedis
+
+# 用法：
+#   python bench/replay.py --users 50 --concurrency 10
+#   python bench/replay.py --generate traffic.jsonl --users 200
+#   python bench/replay.py --traffic traffic.jsonl --save-baseline bench/baseline.json
+#   python bench/replay.py --traffic traffic.jsonl --baseline bench/baseline.json
+#   python bench/replay.py --shared-state redis   # session 等狀態改存本機 Redis 替身
+
+CHANNEL_SECRET = "bench-secret"
+DEVELOPER_ID = "shaintane"
+SUBJECT_WORDS = ["免疫", "微生物", "生化", "血庫", "分子", "病理"]
+NUM_ANSWERS = 5
+
+def synthesize(users, seed=0):
+    # 每位學生：選科、作答五題、查詢一題解析；另含一段開發者註冊流程
+    rnd = random.Random(seed)
+    events = [
+        {"user": DEVELOPER_ID, "text": "測試"},
+        {"user": DEVELOPER_ID, "text": "基準大學 測試員 B000001 2025-01-01 2099-12-31"}
+    ]
+    for i in range(users):
+        user = f"U{i:032d}"
+        events.append({"user": user, "text": rnd.choice(SUBJECT_WORDS)})
+        for _ in range(NUM_ANSWERS):
+            events.append({"user": user, "text": rnd.choice("ABCD")})
+        events.append({"user": user, "text": f"題號{rnd.randint(1, NUM_ANSWERS)}"})
+    return events
+
+def load_traffic(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def write_traffic(path, events):
+    with open(path, "w", encoding="utf-8") as f:
+        for e in events:
+            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+
+def configure_env(fake_url, workdir, mode, shared_state="memory"):
+    os.environ.update({
+        "SHARED_STATE": shared_state,
+        "CHANNEL_SECRET": CHANNEL_SECRET,
+        "CHANNEL_ACCESS_TOKEN": "bench-token",
+        "OPENAI_API_KEY": "bench-key",
+        "OPENAI_BASE_URL": f"{fake_url}/v1",
+        "LINE_API_ENDPOINT": fake_url,
+        "GITHUB_API_URL": fake_url,
+        "DISPATCH_MODE": mode,
+        "BANK_CACHE_DIR": os.path.join(workdir, "bank_cache"),
+        "BANK_COMPILED_DIR": os.path.join(workdir, "compiled_banks"),
+        "EXPLAIN_CACHE_DIR": os.path.join(workdir, "explain_cache"),
+        "RESULTS_LOG_DIR": os.path.join(workdir, "results_log"),
+        "REGISTRY_DB": os.path.join(workdir, "registry.db"),
+        "SEND_RETRY_BASE": "0.05",
+        # 合成的學生不在白名單內
+        "ENTITLEMENT_ENFORCE": "false"
+    })
+
+def webhook_body(user, text, event_id=None, redelivery=False):
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user},
+        "webhookEventId": event_id or uuid.uuid4().hex.upper()[:26],
+        "deliveryContext": {"isRedelivery": redelivery},
+        "replyToken": uuid.uuid4().hex,
+        "message": {"type": "text", "id": str(random.randint(10 ** 12, 10 ** 13)), "text": text}
+    }
+    return json.dumps({"destination": "Ubench", "events": [event]}, ensure_ascii=False)
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("utf-8")
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    f = int(k)
+    c = min(f + 1, len(values) - 1)
+    return values[f] + (values[c] - values[f]) * (k - f)
+
+def run(events, concurrency, mode, openai_latency, bank_size, shared_state="memory", redeliver_rate=0.0):
+    import requests
+    workdir = tempfile.mkdtemp(prefix="line-exam-bench-")
+    fake = FakeServices(openai_latency=openai_latency, bank_size=bank_size).start()
+    fake_redis = None
+    if shared_state == "redis":
+        fake_redis = FakeRedis().start()
+        shared_state = fake_redis.url
+    elif shared_state == "sqlite":
+        shared_state = "sqlite:///" + os.path.join(workdir, "state.db")
+    configure_env(fake.url, workdir, mode, shared_state)
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    import app as bot
+    if not bot.startup.ready.wait(60):
+        raise RuntimeError("warm-up did not finish")
+    server = make_server("127.0.0.1", 0, bot.app, threaded=True, request_handler=QuietHandler)
+    threading.Thread(target=server.serve_forever, name="bench-app", daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/callback"
+
+    # 同一使用者的事件依序送出，不同使用者依 concurrency 平行
+    by_user = OrderedDict()
+    for e in events:
+        by_user.setdefault(e["user"], []).append(e["text"])
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+    local = threading.local()
+
+    redelivered = [0]
+
+    def post(body):
+        t = time.perf_counter()
+        res = local.session.post(url, data=body.encode("utf-8"), headers={
+            "Content-Type": "application/json",
+            "X-Line-Signature": sign(body)
+        })
+        elapsed = time.perf_counter() - t
+        with lock:
+            latencies.append(elapsed)
+            statuses[res.status_code] = statuses.get(res.status_code, 0) + 1
+
+    def replay_user(texts, user):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        for text in texts:
+            event_id = uuid.uuid4().hex.upper()[:26]
+            post(webhook_body(user, text, event_id))
+            # 模擬 LINE 重送同一事件（isRedelivery=true），應被去重而不影響作答
+            if redeliver_rate and random.random() < redeliver_rate:
+                post(webhook_body(user, text, event_id, redelivery=True))
+                with lock:
+                    redelivered[0] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for f in [pool.submit(replay_user, texts, user) for user, texts in by_user.items()]:
+            f.result()
+    sent = time.perf_counter() - started
+    if bot.dispatcher:
+        for q in bot.dispatcher.queues:
+            q.join()
+    duration = time.perf_counter() - started
+    server.shutdown()
+    fake.stop()
+
+    report = {
+        "events": len(latencies),
+        "users": len(by_user),
+        "concurrency": concurrency,
+        "mode": mode,
+        "shared_state": shared_state.split(":")[0],
+        "openai_latency": openai_latency,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "redelivered": redelivered[0],
+        "dedup": bot.deduplicator.report(),
+        "webhook_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies) * 1000, 2) if latencies else 0.0
+        },
+        "send_seconds": round(sent, 3),
+        "drain_seconds": round(duration, 3),
+        "throughput_eps": round(len(latencies) / duration, 1) if duration else 0.0,
+        "outbound": fake.report(),
+        "memory": {
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "sessions": bot.user_sessions.memory_report()
+        }
+    }
+    if fake_redis:
+        fake_redis.stop()
+    return report
+
+# 數值越小越好的指標；throughput 越大越好
+COMPARED = [
+    ("webhook_ms.p50", False),
+    ("webhook_ms.p95", False),
+    ("webhook_ms.p99", False),
+    ("drain_seconds", False),
+    ("throughput_eps", True),
+    ("memory.max_rss_kb", False)
+]
+
+def _lookup(report, path):
+    for part in path.split("."):
+        report = report.get(part, {}) if isinstance(report, dict) else {}
+    return report if isinstance(report, (int, float)) else None
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    print("\n指標                    基準          本次          變化")
+    for path, higher_is_better in COMPARED:
+        old, new = _lookup(baseline, path), _lookup(report, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = " ⚠️" if worse > tolerance else ""
+        if flag:
+            regressions.append(path)
+        print(f"{path:<22}{old:>12}{new:>14}{change:>+12.1f}%{flag}")
+    for kind in sorted(set(baseline.get("outbound", {}).get("calls", {})) | set(report["outbound"]["calls"])):
+        old = baseline.get("outbound", {}).get("calls", {}).get(kind, 0)
+        new = report["outbound"]["calls"].get(kind, 0)
+        print(f"{'calls.' + kind:<22}{old:>12}{new:>14}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="以本機替身服務重播 webhook 流量並量測延遲")
+    parser.add_argument("--traffic", help="JSONL 流量檔（每行 {\"user\", \"text\"}），未指定時自動產生")
+    parser.add_argument("--generate", help="只產生合成流量到此檔案後結束")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--mode", choices=["async", "sync"], default="async")
+    parser.add_argument("--shared-state", choices=["memory", "sqlite", "redis"], default="memory")
+    parser.add_argument("--redeliver-rate", type=float, default=0.0, help="以此比例重送事件（isRedelivery=true）")
+    parser.add_argument("--openai-latency", type=float, default=0.5)
+    parser.add_argument("--bank-size", type=int, default=200)
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=10.0, help="退步超過此百分比時標示")
+    args = parser.parse_args()
+
+    if args.generate:
+        write_traffic(args.generate, synthesize(args.users, args.seed))
+        print(f"✅ 已產生 {args.generate}")
+        return 0
+
+    events = load_traffic(args.traffic) if args.traffic else synthesize(args.users, args.seed)
+    report = run(events, args.concurrency, args.mode, args.openai_latency, args.bank_size, args.shared_state, args.redeliver_rate)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"✅ 已儲存基準 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n⚠️ 退步指標：{', '.join(regressions)}")
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
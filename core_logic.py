@@ -1,9 +1,8 @@
 from linebot.models import TextSendMessage
 from datetime import datetime
 import difflib
-import requests
-import json
-import os
+from bank_cache import get_question_bank
+from registry import get_registry
 
 def is_valid_date(date_str):
     try:
@@ -22,18 +21,8 @@ def match_subject_name(input_name, alias, subjects):
     return best_match[0] if best_match else None
 
 def load_question_bank(repo):
-    try:
-        api_url = f"https://api.github.com/repos/shaintane/{repo}/contents"
-        res = requests.get(api_url, timeout=5)
-        if res.status_code == 200:
-            files = res.json()
-            for file in files:
-                if file["name"].startswith("question_bank_") and file["name"].endswith(".json"):
-                    raw_url = file["download_url"]
-                    return requests.get(raw_url, timeout=5).json()
-    except:
-        return []
-    return []
+    # 題庫由 bank_cache 快取並於背景以 ETag 重新驗證
+    return get_question_bank(repo)
 
 def format_question(q, index, repo):
     image_url = f"https://raw.githubusercontent.com/shaintane/{repo}/main/{q['圖片連結']}" if q.get("圖片連結") else ""
@@ -67,45 +56,14 @@ def process_message(event, line_bot_api, client, user_sessions, registration_buf
     user_id = event.source.user_id
     user_input = event.message.text.strip()
     DEV_USER_ID = "shaintane"
-    WHITELIST_FILE = "whitelist.json"
-    SUBJECTS = {
-        "臨床血清免疫學": "examimmun",
-        "臨床血液與血庫學": "exmablood",
-        "臨床生物化學": "exambiochemicy",
-        "醫學分子檢驗與鏡檢學": "exammolecu",
-        "臨床生理與病理學": "exampatho",
-        "臨床微生物學": "exammicrbiog"
-    }
-    ALIAS = {
-        "微生物": "臨床微生物學",
-        "微生": "臨床微生物學",
-        "血庫": "臨床血液與血庫學",
-        "血液": "臨床血液與血庫學",
-        "分子": "醫學分子檢驗與鏡檢學",
-        "免疫": "臨床血清免疫學",
-        "生化": "臨床生物化學",
-        "病理": "臨床生理與病理學"
-    }
-    NUM_QUESTIONS = 5
-
-    def load_whitelist():
-        if not os.path.exists(WHITELIST_FILE):
-            return {}
-        with open(WHITELIST_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-
-    def save_whitelist(data):
-        with open(WHITELIST_FILE, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
-
-    whitelist = load_whitelist()
+    registry = get_registry()
 
     # ✅ 修正的 admin 指令邏輯（含 log）
     if user_input.lower().startswith("admin"):
         print("🛠 觸發 admin 指令")
-        if user_id not in whitelist:
+        if user_id not in registry:
             print("➕ 新增管理者進入白名單")
-            whitelist[user_id] = {
+            registry.put("whitelist", {
                 "role": "admin",
                 "name": "管理者",
                 "student_id": "admin",
@@ -113,8 +71,7 @@ def process_message(event, line_bot_api, client, user_sessions, registration_buf
                 "start_date": "2025-01-01",
                 "end_date": "2099-12-31",
                 "line_id": user_id
-            }
-            save_whitelist(whitelist)
+            })
         else:
             print("✅ 已存在 whitelist")
         print("📤 發送成功訊息")
@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from metrics import inc, register_collector, stats_series
+from shared_state import get_backend, is_shared
+
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "3600"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "50000"))
+
+class WebhookDeduplicator:
+    # 以 webhookEventId 去除 LINE 重送的事件：本機 LRU + TTL 在前，多 worker 時再以共用後端原子判斷
+    # 非重送事件（isRedelivery=false）不可能重複，只記錄不查詢
+    def __init__(self, backend=None, ttl=DEDUP_TTL, max_entries=DEDUP_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"recorded": 0, "redeliveries": 0, "suppressed": 0}
+        register_collector(lambda: stats_series("dedup_", self.report(), gauges=("tracked",)))
+
+    def _expire(self, now):
+        while self.seen:
+            event_id, expires = next(iter(self.seen.items()))
+            if expires > now and len(self.seen) <= self.max_entries:
+                break
+            del self.seen[event_id]
+
+    def first_delivery(self, event):
+        # 第一次收到此事件時回傳 True；重送且已處理過時回傳 False
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return True
+        context = getattr(event, "delivery_context", None)
+        redelivery = bool(getattr(context, "is_redelivery", False))
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            duplicate = redelivery and event_id in self.seen
+            self.seen[event_id] = now + self.ttl
+            self.seen.move_to_end(event_id)
+            self.stats["recorded"] += 1
+            self.stats["redeliveries"] += redelivery
+        if not duplicate and self.backend is not None:
+            first = self.backend.add_if_absent("webhook_event", event_id, b"1", self.ttl)
+            duplicate = redelivery and not first
+        if duplicate:
+            with self.lock:
+                self.stats["suppressed"] += 1
+            inc("webhook_duplicates_total")
+        return not duplicate
+
+    def forget(self, event):
+        # 事件未能處理（例如佇列已滿回 503）時移除紀錄，讓 LINE 重送時仍會處理
+        event_id = getattr(event, "webhook_event_id", None)
+        if not event_id:
+            return
+        with self.lock:
+            self.seen.pop(event_id, None)
+        if self.backend is not None:
+            self.backend.delete("webhook_event", event_id)
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["tracked"] = len(self.seen)
+        return stats
+
+deduplicator = WebhookDeduplicator(get_backend() if is_shared() else None)
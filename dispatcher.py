@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+import zlib
+
+class DispatchQueueFull(Exception):
+    pass
+
+_STOP = object()
+
+class EventDispatcher:
+    # 依 user_id 分片：同一學生的事件固定進同一條 worker，確保作答順序；不同學生平行處理
+    def __init__(self, workers=4, queue_size=100, put_timeout=2.0):
+        self.put_timeout = put_timeout
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self.closed = False
+        self.deadline = None
+        self.dropped = 0
+        self.lock = threading.Lock()
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(q,), name=f"dispatch-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def _shard(self, key):
+        return self.queues[zlib.crc32(str(key).encode("utf-8")) % len(self.queues)]
+
+    def submit(self, key, func, *args):
+        if self.closed:
+            raise DispatchQueueFull("dispatcher is shutting down")
+        try:
+            # 佇列滿時短暫阻塞形成背壓，逾時則交由呼叫端回應 503
+            self._shard(key).put((func, args), timeout=self.put_timeout)
+        except queue.Full:
+            raise DispatchQueueFull(f"queue full for {key}")
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            try:
+                if item is _STOP:
+                    return
+                func, args = item
+                func(*args)
+            except Exception as e:
+                print(f"⚠️ 背景事件處理失敗：{e}")
+            finally:
+                q.task_done()
+            if self.deadline is not None and time.time() >= self.deadline:
+                # 超過收尾期限：丟棄剩餘事件，讓 process 能在 graceful timeout 前結束
+                self._drop(q)
+                return
+
+    def _drop(self, q):
+        while True:
+            try:
+                item = q.get_nowait()
+            except queue.Empty:
+                return
+            if item is not _STOP:
+                with self.lock:
+                    self.dropped += 1
+            q.task_done()
+
+    def pending(self):
+        return sum(q.qsize() for q in self.queues)
+
+    def shutdown(self, timeout=25.0):
+        # 停止收件後送出結束標記，等待已排隊的事件處理完畢
+        if self.closed:
+            return
+        self.closed = True
+        deadline = self.deadline = time.time() + timeout
+        for q in self.queues:
+            try:
+                # 佇列已滿時不等待，worker 會在期限到時自行丟棄剩餘事件並結束
+                q.put_nowait(_STOP)
+            except queue.Full:
+                pass
+        for t in self.threads:
+            t.join(max(0, deadline - time.time()))
+        dropped = self.dropped + self.pending()
+        if dropped:
+            print(f"⚠️ 關閉時仍有 {dropped} 個事件未處理，已丟棄")
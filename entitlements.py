@@ -0,0 +1,159 @@
+import heapq
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from metrics import inc, register_collector, stats_series
+from registry import get_registry
+from shared_state import get_backend
+
+ENTITLEMENT_ENFORCE = os.getenv("ENTITLEMENT_ENFORCE", "true").lower() == "true"
+# 到期前幾天提醒續約，0 表示不提醒
+RENEWAL_NOTICE_DAYS = int(os.getenv("RENEWAL_NOTICE_DAYS", "0"))
+# 白名單日期以台灣時間解讀
+ENTITLEMENT_TZ = timezone(timedelta(hours=float(os.getenv("ENTITLEMENT_UTC_OFFSET", "8"))))
+
+def parse_date(date_str, end=False):
+    # 起始日當天 00:00 生效，結束日當天結束才失效；空白視為不限
+    if not date_str:
+        return None
+    day = datetime.strptime(date_str.strip(), "%Y-%m-%d").replace(tzinfo=ENTITLEMENT_TZ)
+    return (day + timedelta(days=1) if end else day).timestamp()
+
+def parse_window(entry):
+    return parse_date(entry.get("start_date")), parse_date(entry.get("end_date"), end=True)
+
+class EntitlementService:
+    # 白名單載入一次並解析成 LINE ID → (起始, 結束) 時間戳，查詢 O(1)
+    # 到期與續約提醒排入最小堆積，由背景執行緒依時間處理；名單異動時就地更新
+    def __init__(self, registry, notify=None, notice_days=RENEWAL_NOTICE_DAYS):
+        self.registry = registry
+        self.notify = notify
+        self.notice_days = notice_days
+        self.windows = {}
+        self.invalid = set()
+        self.timers = []
+        self.cond = threading.Condition()
+        self.stats = {"expired": 0, "notices": 0, "invalid": 0}
+        self.load()
+        registry.subscribe(self._on_change)
+        threading.Thread(target=self._run, name="entitlements", daemon=True).start()
+        register_collector(lambda: [("entitlements", {}, len(self.windows))] + stats_series("entitlements_", self.stats))
+
+    def load(self):
+        entries = self.registry.all("whitelist")
+        with self.cond:
+            self.windows = {}
+            self.invalid = set()
+            self.timers = []
+            for entry in entries:
+                self._set(entry)
+            self.cond.notify()
+
+    def _set(self, entry):
+        line_id = entry["line_id"]
+        self.invalid.discard(line_id)
+        try:
+            start, end = parse_window(entry)
+        except ValueError:
+            # 日期格式錯誤時視同未開通，由管理者修正後才可使用
+            print(f"⚠️ 白名單日期格式錯誤：{line_id} {entry.get('start_date')}~{entry.get('end_date')}")
+            self.stats["invalid"] += 1
+            self.invalid.add(line_id)
+            self.windows.pop(line_id, None)
+            return
+        now = time.time()
+        if end is not None and end <= now:
+            self.windows.pop(line_id, None)
+            return
+        self.windows[line_id] = (start, end)
+        if end is not None:
+            heapq.heappush(self.timers, (end, "expire", line_id, end))
+            if self.notify and self.notice_days:
+                notice_at = end - self.notice_days * 86400
+                if notice_at > now:
+                    heapq.heappush(self.timers, (notice_at, "notice", line_id, end))
+
+    def _on_change(self, ops):
+        if ops is None:
+            # 其他 worker 寫入後整份名單重新載入
+            self.load()
+            return
+        with self.cond:
+            for op, kind, value in ops:
+                if kind != "whitelist":
+                    continue
+                if op == "put":
+                    self._set(value)
+                else:
+                    self.windows.pop(value, None)
+                    self.invalid.discard(value)
+            self.cond.notify()
+
+    def allowed(self, line_id, now=None):
+        self.registry.sync()
+        window = self.windows.get(line_id)
+        if window is None:
+            return False
+        now = now or time.time()
+        start, end = window
+        return (start is None or start <= now) and (end is None or now < end)
+
+    def status(self, line_id, now=None):
+        # 回傳 ok / not_registered / not_started / expired / invalid
+        self.registry.sync()
+        window = self.windows.get(line_id)
+        if window is None:
+            if line_id in self.invalid:
+                return "invalid"
+            entry = self.registry.get("whitelist", line_id)
+            return "expired" if entry else "not_registered"
+        now = now or time.time()
+        if window[0] is not None and now < window[0]:
+            return "not_started"
+        if window[1] is not None and now >= window[1]:
+            return "expired"
+        return "ok"
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.timers or self.timers[0][0] > time.time():
+                    self.cond.wait(timeout=self.timers[0][0] - time.time() if self.timers else None)
+                when, action, line_id, end = heapq.heappop(self.timers)
+                window = self.windows.get(line_id)
+                # 名單已更新（延期或移除）的舊計時直接略過
+                if window is None or window[1] != end:
+                    continue
+                if action == "expire":
+                    del self.windows[line_id]
+                    self.stats["expired"] += 1
+                    inc("entitlements_expired_total")
+                    continue
+            self._send_notice(line_id, end)
+
+    def _send_notice(self, line_id, end):
+        # 多個 worker 各自排程，以共用後端確保同一筆只提醒一次
+        if not get_backend().add_if_absent("renewal_notice", f"{line_id}:{int(end)}", b"1", ttl=self.notice_days * 86400 + 86400):
+            return
+        try:
+            entry = self.registry.get("whitelist", line_id) or {}
+            self.notify(line_id, entry)
+            self.stats["notices"] += 1
+        except Exception as e:
+            print(f"⚠️ 續約提醒傳送失敗 {line_id}：{e}")
+
+_entitlements = None
+_notifier = None
+_entitlements_lock = threading.Lock()
+
+def set_notifier(notify):
+    global _notifier
+    _notifier = notify
+
+def get_entitlements():
+    global _entitlements
+    with _entitlements_lock:
+        if _entitlements is None:
+            _entitlements = EntitlementService(get_registry(), _notifier)
+        return _entitlements
@@ -1,142 +1,200 @@
 from linebot.models import TextSendMessage
-import requests
-import json
-import difflib
-import random
+from bank_cache import bank_version, get_question_bank, same_bank_version
+from bank_compiler import CompiledBank
+from explanation_cache import explanation_cache, explanation_key
+from session_store import ExamSession, SessionConflict
+from metrics import inc, timed
+from prefetch import ExplanationPrefetcher
+from llm_gateway import GatewayRejected, gateway
+from entitlements import ENTITLEMENT_ENFORCE, get_entitlements
+from admin_logic import is_admin
+from analytics import results_analytics
+from sampling import EXAM_NUM_QUESTIONS, sampler
+
+# 科目表於模組載入時建立一次
+SUBJECTS = {
+    "臨床血清免疫學": "examimmun",
+    "臨床血液與血庫學": "exmablood",
+    "臨床生物化學": "exambiochemicy",
+    "醫學分子檢驗與鏡檢學": "exammolecu",
+    "臨床生理與病理學": "exampatho",
+    "臨床微生物學": "exammicrbiog"
+}
+ALIAS = {
+    "微生物": "臨床微生物學",
+    "微生": "臨床微生物學",
+    "血庫": "臨床血液與血庫學",
+    "血液": "臨床血液與血庫學",
+    "分子": "醫學分子檢驗與鏡檢學",
+    "免疫": "臨床血清免疫學",
+    "生化": "臨床生物化學",
+    "病理": "臨床生理與病理學"
+}
+NUM_QUESTIONS = EXAM_NUM_QUESTIONS
+ENTITLEMENT_MESSAGES = {
+    "not_registered": "⚠️ 你尚未開通測驗權限，請先完成註冊並等待管理者審核。",
+    "not_started": "⚠️ 你的使用期間尚未開始，請於起始日後再試。",
+    "expired": "⚠️ 你的使用期間已結束，如需續用請聯絡管理者。",
+    "invalid": "⚠️ 你的使用期間設定有誤，請聯絡管理者修正。"
+}
 
 def normalize_answer(ans):
     return ans.strip().replace('.', '').replace('．', '').upper().replace('Ｂ', 'B').replace('Ａ', 'A').replace('Ｃ', 'C').replace('Ｄ', 'D')
 
-def match_subject_name(input_name, alias, subjects):
-    if input_name in alias:
-        input_name = alias[input_name]
-    best_match = difflib.get_close_matches(input_name, subjects.keys(), n=1, cutoff=0.4)
-    return best_match[0] if best_match else None
-
 def load_question_bank(repo):
-    try:
-        api_url = f"https://api.github.com/repos/shaintane/{repo}/contents"
-        res = requests.get(api_url, timeout=5)
-        if res.status_code == 200:
-            files = res.json()
-            for file in files:
-                if file["name"].startswith("question_bank_") and file["name"].endswith(".json"):
-                    raw_url = file["download_url"]
-                    return requests.get(raw_url, timeout=5).json()
-    except:
-        return []
-    return []
+    # 題庫由 bank_cache 快取並於背景以 ETag 重新驗證
+    return get_question_bank(repo)
 
 def format_question(q, index, repo):
     image_url = f"https://raw.githubusercontent.com/shaintane/{repo}/main/{q['圖片連結']}" if q.get("圖片連結") else ""
     base = f"第 {index+1} 題：{q['題目']}\n" + "\n".join(q['選項'])
     return base + (f"\n\n{image_url}" if image_url else "")
 
-def handle_exam_logic(user_input, user_id, event, line_bot_api, client, user_sessions, registration_buffer):
-    SUBJECTS = {
-        "臨床血清免疫學": "examimmun",
-        "臨床血液與血庫學": "exmablood",
-        "臨床生物化學": "exambiochemicy",
-        "醫學分子檢驗與鏡檢學": "exammolecu",
-        "臨床生理與病理學": "exampatho",
-        "臨床微生物學": "exammicrbiog"
-    }
-    ALIAS = {
-        "微生物": "臨床微生物學",
-        "微生": "臨床微生物學",
-        "血庫": "臨床血液與血庫學",
-        "血液": "臨床血液與血庫學",
-        "分子": "醫學分子檢驗與鏡檢學",
-        "免疫": "臨床血清免疫學",
-        "生化": "臨床生物化學",
-        "病理": "臨床生理與病理學"
-    }
-    NUM_QUESTIONS = 5
+def question_text(session, pos):
+    # 編譯題庫已預先排版，直接取用
+    if isinstance(session.bank, CompiledBank):
+        return session.bank.render(session.indices[pos], pos)
+    return format_question(session.question(pos), pos, session.repo)
 
-    if user_id not in user_sessions or user_sessions[user_id].get("completed"):
-        subject = match_subject_name(user_input, ALIAS, SUBJECTS)
-        if subject:
-            repo = SUBJECTS[subject]
-            question_bank = load_question_bank(repo)
-            if not question_bank:
-                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 題庫載入失敗"))
-                return
-            questions = random.sample(question_bank, min(NUM_QUESTIONS, len(question_bank)))
-            for idx, q in enumerate(questions):
-                q["題號"] = idx + 1
-            user_sessions[user_id] = {
-                "repo": repo,
-                "subject": subject,
-                "questions": questions,
-                "current": 0,
-                "answers": [],
-                "解析次數": 0,
-                "completed": False
-            }
-            q = questions[0]
-            message = format_question(q, 0, repo)
-            line_bot_api.push_message(user_id, TextSendMessage(text=f"✅ 已選擇『{subject}』科目，開始測驗：\n{message}"))
-            return
+def correct_answer(session, pos):
+    if isinstance(session.bank, CompiledBank):
+        return session.bank.answer(session.indices[pos])
+    return normalize_answer(session.question(pos)["正解"])
 
-    if user_id in user_sessions:
-        session = user_sessions[user_id]
-        user_input_normalized = normalize_answer(user_input)
+def start_exam(ctx, subject):
+    user_id, line_bot_api = ctx.user_id, ctx.line_bot_api
+    if ENTITLEMENT_ENFORCE and not is_admin(user_id) and not get_entitlements().allowed(user_id):
+        status = get_entitlements().status(user_id)
+        inc("exams_denied_total", reason=status)
+        line_bot_api.push_message(user_id, TextSendMessage(text=ENTITLEMENT_MESSAGES.get(status, ENTITLEMENT_MESSAGES["expired"])))
+        return
+    repo = SUBJECTS[subject]
+    question_bank = load_question_bank(repo)
+    if not question_bank:
+        line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 題庫載入失敗"))
+        return
+    # 只記錄題目在題庫中的索引，不複製也不修改共用的題目 dict
+    # 依學生過去作答加權抽題：未做過的優先、最近答錯的加重
+    with timed("sampling", subject=repo):
+        indices = sampler.draw(user_id, repo, len(question_bank), NUM_QUESTIONS)
+    session = ExamSession(repo, subject, question_bank, indices, bank_version(repo, question_bank))
+    # 以舊 session 的版本號寫入，其他 worker 若同時更新則由 router 重新處理
+    session.version = ctx.session.version if ctx.session else 0
+    ctx.user_sessions.save(user_id, session)
+    inc("exams_started_total", subject=repo)
+    message = question_text(session, 0)
+    line_bot_api.push_message(user_id, TextSendMessage(text=f"✅ 已選擇『{subject}』科目，開始測驗：\n{message}"))
 
-        if user_input.startswith("題號"):
-            try:
-                tid = int(user_input.replace("題號", "").strip())
-                if session["解析次數"] >= 3:
-                    line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 你已達到本次測驗解析上限（3題）。"))
-                    return
-                q = next((q for q in session["questions"] if q["題號"] == tid), None)
-                a = next((a for a in session["answers"] if a["題號"] == tid), None)
-                if q and a:
-                    explanation = generate_explanation(client, q, a["作答"])
-                    if explanation:
-                        session["解析次數"] += 1
-                        image_url = f"https://raw.githubusercontent.com/shaintane/{session['repo']}/main/{q['圖片連結']}" if q.get("圖片連結") else ""
-                        text = f"📘 題號 {tid} 解析：\n{explanation}" + (f"\n\n🔗 圖片：{image_url}" if image_url else "")
-                        line_bot_api.push_message(user_id, TextSendMessage(text=text))
-                    else:
-                        line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 無法生成解析，請稍後再試"))
-                else:
-                    line_bot_api.push_message(user_id, TextSendMessage(text=f"⚠️ 查無題號 {tid} 的紀錄。"))
-            except:
-                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 請輸入正確格式：題號3"))
-            return
+def bank_changed(session):
+    # 共用 session 每次依 repo 重新取得題庫、編譯檔也可能被換新：版本不同時索引已對應到別的題目
+    return session.bank_version is not None and not same_bank_version(session.bank_version, bank_version(session.repo, session.bank))
 
-        if session["current"] < NUM_QUESTIONS:
-            current_q = session["questions"][session["current"]]
-            if user_input_normalized not in ['A', 'B', 'C', 'D']:
-                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 請填入 A / B / C / D 作為答案。"))
-                return
-            correct = normalize_answer(current_q["正解"])
-            session["answers"].append({
-                "題號": current_q["題號"],
-                "作答": user_input_normalized,
-                "正解": correct,
-                "是否正確": user_input_normalized == correct
-            })
-            session["current"] += 1
-            if session["current"] < NUM_QUESTIONS:
-                next_q = session["questions"][session["current"]]
-                message = format_question(next_q, session["current"], session["repo"])
-                line_bot_api.push_message(user_id, TextSendMessage(text=message))
+def explain_question(ctx):
+    user_id, line_bot_api = ctx.user_id, ctx.line_bot_api
+    session = ctx.session or ctx.user_sessions.get(user_id)
+    if session is None:
+        return
+    if bank_changed(session):
+        line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 題庫已更新，無法提供本次測驗的解析。"))
+        return
+    try:
+        tid = int(ctx.text.replace("題號", "").strip())
+        if session.explain_count >= 3:
+            line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 你已達到本次測驗解析上限（3題）。"))
+            return
+        pos = tid - 1
+        if 0 <= pos < session.current:
+            q = session.question(pos)
+            explanation = generate_explanation(ctx.client, q, session.answer(pos), session.repo)
+            if explanation:
+                session.explain_count += 1
+                ctx.user_sessions.save(user_id, session)
+                if isinstance(session.bank, CompiledBank):
+                    image_url = session.bank.image_url(session.indices[pos])
+                else:
+                    image_url = f"https://raw.githubusercontent.com/shaintane/{session.repo}/main/{q['圖片連結']}" if q.get("圖片連結") else ""
+                text = f"📘 題號 {tid} 解析：\n{explanation}" + (f"\n\n🔗 圖片：{image_url}" if image_url else "")
+                line_bot_api.push_message(user_id, TextSendMessage(text=text))
             else:
-                answers = session["answers"]
-                wrong = [a for a in answers if not a["是否正確"]]
-                correct_count = NUM_QUESTIONS - len(wrong)
-                rate = round((correct_count / NUM_QUESTIONS) * 100, 1)
-                summary = f"📩 測驗已完成\n共 {NUM_QUESTIONS} 題，正確 {correct_count} 題，正確率 {rate}%\n\n"
-                summary += "錯題如下：\n" if wrong else "全部答對！"
-                summary += "\n".join([f"題號 {w['題號']}（你選 {w['作答']}） 正解 {w['正解']}" for w in wrong])
-                summary += "\n\n💡 想查看解析請輸入：題號3"
-                summary += "\n\n📘 想選擇其他科目請輸入『微生物』或『免疫』等關鍵字。"
-                line_bot_api.push_message(user_id, TextSendMessage(text=summary))
-                session["completed"] = True
+                line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 無法生成解析，請稍後再試"))
+        else:
+            line_bot_api.push_message(user_id, TextSendMessage(text=f"⚠️ 查無題號 {tid} 的紀錄。"))
+    except SessionConflict:
+        raise
+    except:
+        line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 請輸入正確格式：題號3"))
+
+def answer_question(ctx, letter):
+    user_id, line_bot_api, session = ctx.user_id, ctx.line_bot_api, ctx.session
+    if bank_changed(session):
+        # 不以新題庫的題目批改舊題目的作答，直接結束本次測驗
+        session.completed = True
+        ctx.user_sessions.save(user_id, session)
+        line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 題庫已更新，本次測驗已中止，請重新輸入科目開始新的測驗。"))
+        inc("exams_aborted_total", subject=session.repo, reason="bank_changed")
+        return
+    if letter is None:
+        # 查表未命中時再以 normalize_answer 處理其他寫法
+        letter = normalize_answer(ctx.text)
+        if letter not in ['A', 'B', 'C', 'D']:
+            line_bot_api.push_message(user_id, TextSendMessage(text="⚠️ 請填入 A / B / C / D 作為答案。"))
             return
+    session.record(letter)
+    if session.current < session.size:
+        # 先寫回 session 再送出訊息，版本衝突重試時不會重複送出
+        ctx.user_sessions.save(user_id, session)
+        message = question_text(session, session.current)
+        line_bot_api.push_message(user_id, TextSendMessage(text=message))
+        return
+    total = session.size
+    wrong = []
+    corrects = []
+    for pos in range(total):
+        correct = correct_answer(session, pos)
+        corrects.append(correct)
+        if session.answer(pos) != correct:
+            wrong.append((pos + 1, session.answer(pos), correct))
+    correct_count = total - len(wrong)
+    rate = round((correct_count / total) * 100, 1)
+    summary = f"📩 測驗已完成\n共 {total} 題，正確 {correct_count} 題，正確率 {rate}%\n\n"
+    summary += "錯題如下：\n" if wrong else "全部答對！"
+    summary += "\n".join([f"題號 {tid}（你選 {ans}） 正解 {correct}" for tid, ans, correct in wrong])
+    summary += "\n\n💡 想查看解析請輸入：題號3"
+    summary += "\n\n📘 想選擇其他科目請輸入『微生物』或『免疫』等關鍵字。"
+    session.completed = True
+    ctx.user_sessions.save(user_id, session)
+    line_bot_api.push_message(user_id, TextSendMessage(text=summary))
+    inc("exams_completed_total", subject=session.repo)
+    sampler.record(user_id, session.repo, len(session.bank), [
+        (session.indices[pos], session.answer(pos) == corrects[pos]) for pos in range(total)
+    ])
+    try:
+        results_analytics.record(user_id, session, corrects)
+    except OSError as e:
+        print(f"⚠️ 作答紀錄寫入失敗：{e}")
+    # 背景預先產生錯題解析；解析次數仍於實際送出時才計算
+    prefetcher.schedule(ctx.client, [(session.question(tid - 1), ans, session.repo) for tid, ans, _ in wrong])
 
-def generate_explanation(client, question, student_answer):
+def register_routes(router):
+    router.command("題號", explain_question)
+    router.answer(answer_question)
+    router.subject(start_exam)
+
+EXPLAIN_MODEL = "gpt-3.5-turbo"
+
+def generate_explanation(client, question, student_answer, repo=None, prefetch=False, on_send=None):
+    # 命中快取時直接回傳，不呼叫 OpenAI
+    key = explanation_key(question, student_answer, EXPLAIN_MODEL)
+    cached = explanation_cache.get(repo, key)
+    if cached is not None:
+        inc("explanations_total", subject=repo, source="cache")
+        return cached
+    if not prefetch:
+        # 背景產生被拒絕或失敗時回傳 None，改以學生請求一般的等待上限呼叫
+        pending = prefetcher.join(key)
+        if pending:
+            inc("explanations_total", subject=repo, source="prefetch")
+            return pending
     correct = question["正解"]
     prompt = f"""
 你是一位國考輔導老師，請針對下列題目進行解析：
@@ -147,14 +205,30 @@ def generate_explanation(client, question, student_answer):
 請指出學生是否正確，並簡要解釋為什麼正解正確，以及錯解的迷思點。
 """
     try:
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "你是一位專業的國考解析導師。"},
-                {"role": "user", "content": prompt}
-            ],
-            timeout=10
-        )
-        return response.choices[0].message.content.strip()
+        # 經由 gateway 限流與合併；背景預先產生時不排隊等待，避免擠掉學生即時的請求
+        with timed("openai", subject=repo):
+            explanation = gateway.complete(
+                client,
+                max_wait=0 if prefetch else None,
+                on_send=on_send,
+                model=EXPLAIN_MODEL,
+                messages=[
+                    {"role": "system", "content": "你是一位專業的國考解析導師。"},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+    except GatewayRejected as e:
+        inc("explanations_total", subject=repo, source=e.reason)
+        return None
     except:
         return None
+    if explanation:
+        inc("explanations_total", subject=repo, source="openai")
+        explanation_cache.put(repo, key, explanation)
+    return explanation
+
+prefetcher = ExplanationPrefetcher(
+    generate_explanation,
+    lambda question, student_answer: explanation_key(question, student_answer, EXPLAIN_MODEL),
+    explanation_cache.contains
+)
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from shared_state import get_backend
+
+EXPLAIN_CACHE_DIR = os.getenv("EXPLAIN_CACHE_DIR", "explain_cache")
+EXPLAIN_CACHE_MEMORY_ITEMS = int(os.getenv("EXPLAIN_CACHE_MEMORY_ITEMS", "2000"))
+EXPLAIN_CACHE_MAX_BYTES = int(os.getenv("EXPLAIN_CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+# 各科目的快取世代存放於 shared_state 後端，清除快取時遞增；每個 worker 最多每隔此秒數重新讀取一次
+EXPLAIN_CACHE_SYNC_INTERVAL = float(os.getenv("EXPLAIN_CACHE_SYNC_INTERVAL", "1"))
+
+def explanation_key(question, student_answer, model):
+    # 內容定址：只要題目、選項、正解、學生作答與模型相同就共用同一份解析
+    payload = json.dumps(
+        [question["題目"], question["選項"], question["正解"], student_answer, model],
+        ensure_ascii=False, separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ExplanationCache:
+    # 記憶體 LRU 在前，本機磁碟在後；磁碟依總大小淘汰最舊的檔案
+    # 快取項目屬於所在科目的世代：清除時遞增世代，其他 worker（含其他機器）的記憶體與磁碟快取隨之失效
+    def __init__(self, directory=EXPLAIN_CACHE_DIR, memory_items=EXPLAIN_CACHE_MEMORY_ITEMS, max_bytes=EXPLAIN_CACHE_MAX_BYTES,
+                 backend=None, sync_interval=EXPLAIN_CACHE_SYNC_INTERVAL):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.sync_interval = sync_interval
+        self.generations = {}
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.disk_bytes = None
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _backend(self):
+        return self.backend or get_backend()
+
+    def _generation(self, repo):
+        now = time.time()
+        with self.lock:
+            cached = self.generations.get(repo)
+        if cached and now - cached[1] < self.sync_interval:
+            return cached[0]
+        raw, _ = self._backend().get("explain_generation", repo or "_")
+        generation = int(raw) if raw else 0
+        with self.lock:
+            self.generations[repo] = (generation, now)
+        return generation
+
+    def _path(self, repo, key, generation=0):
+        # 第 0 代沿用原本的目錄結構，之後每代一個子目錄
+        base = os.path.join(self.directory, repo or "_")
+        return os.path.join(base, f"g{generation}", f"{key}.txt") if generation else os.path.join(base, f"{key}.txt")
+
+    def _remember(self, repo, key, text, generation):
+        self.memory[(repo, key)] = (generation, text)
+        self.memory.move_to_end((repo, key))
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def get(self, repo, key):
+        generation = self._generation(repo)
+        with self.lock:
+            item = self.memory.get((repo, key))
+            if item is not None and item[0] == generation:
+                self.memory.move_to_end((repo, key))
+                self.stats["memory_hits"] += 1
+                return item[1]
+        path = self._path(repo, key, generation)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.stats["misses"] += 1
+            return None
+        with self.lock:
+            self._remember(repo, key, text, generation)
+            self.stats["disk_hits"] += 1
+        return text
+
+    def contains(self, repo, key):
+        # 不計入命中統計的存在檢查
+        generation = self._generation(repo)
+        with self.lock:
+            item = self.memory.get((repo, key))
+            if item is not None and item[0] == generation:
+                return True
+        return os.path.exists(self._path(repo, key, generation))
+
+    def put(self, repo, key, text):
+        generation = self._generation(repo)
+        path = self._path(repo, key, generation)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"⚠️ 解析快取寫入失敗：{e}")
+        with self.lock:
+            self._remember(repo, key, text, generation)
+            self.stats["stores"] += 1
+            if self.disk_bytes is not None:
+                self.disk_bytes += len(text.encode("utf-8"))
+        self._enforce_size()
+
+    def _scan(self):
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".txt"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _enforce_size(self):
+        if self.disk_bytes is not None and self.disk_bytes <= self.max_bytes:
+            return
+        files = self._scan()
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            # 超過上限時一次清到 90%，避免每次寫入都掃描目錄
+            files.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                with self.lock:
+                    self.stats["evictions"] += 1
+        with self.lock:
+            self.disk_bytes = total
+
+    def invalidate_repo(self, repo):
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", repo or ""):
+            return 0
+        # 先遞增共用世代，其他 worker 下次同步後即不再使用舊的記憶體與磁碟快取
+        backend = self._backend()
+        while True:
+            raw, version = backend.get("explain_generation", repo)
+            generation = (int(raw) if raw else 0) + 1
+            if backend.cas("explain_generation", repo, version, str(generation).encode("ascii")):
+                break
+        with self.lock:
+            self.generations[repo] = (generation, time.time())
+            keys = [k for k in self.memory if k[0] == repo]
+            for k in keys:
+                del self.memory[k]
+            self.disk_bytes = None
+        removed = 0
+        repo_dir = os.path.join(self.directory, repo)
+        if os.path.isdir(repo_dir):
+            removed = sum(1 for _, _, names in os.walk(repo_dir) for n in names if n.endswith(".txt"))
+            shutil.rmtree(repo_dir, ignore_errors=True)
+        return max(removed, len(keys))
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["memory_items"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups * 100, 1) if lookups else 0.0
+        return stats
+
+explanation_cache = ExplanationCache()
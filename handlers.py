@@ -1,9 +1,14 @@
-from admin_logic import handle_admin_commands
-from exam_logic import handle_exam_logic
+import admin_logic
+import exam_logic
+from router import MessageContext, Router
+
+# 路由表於啟動時編譯一次
+ROUTER = Router(exam_logic.SUBJECTS, exam_logic.ALIAS, admin_logic.is_admin)
+admin_logic.register_routes(ROUTER)
+exam_logic.register_routes(ROUTER)
 
 def process_message(event, line_bot_api, client, user_sessions, registration_buffer):
     user_id = event.source.user_id
     user_input = event.message.text.strip()
-
-    # 測驗流程邏輯
-    handle_exam_logic(user_input, user_id, event, line_bot_api, client, user_sessions, registration_buffer)
+    ctx = MessageContext(event, user_id, user_input, line_bot_api, client, user_sessions, registration_buffer)
+    return ROUTER.dispatch(ctx)
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+import metrics
+
+LLM_RATE_PER_SEC = float(os.getenv("LLM_RATE_PER_SEC", "3"))
+LLM_BURST = int(os.getenv("LLM_BURST", "10"))
+LLM_MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "2"))
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "10"))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "5"))
+LLM_BREAKER_ERROR_RATE = float(os.getenv("LLM_BREAKER_ERROR_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+class GatewayRejected(Exception):
+    # reason：rate_limited / busy / circuit_open
+    def __init__(self, reason):
+        super(GatewayRejected, self).__init__(reason)
+        self.reason = reason
+
+class TokenBucket:
+    # 先預約 token 再於鎖外等待；需等待超過 max_wait 時直接拒絕，不佔用 token
+    def __init__(self, rate=LLM_RATE_PER_SEC, capacity=LLM_BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, max_wait):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+        if wait:
+            time.sleep(wait)
+        return wait
+
+class CircuitBreaker:
+    # 最近 window 次呼叫的錯誤率超過門檻即跳脫；冷卻後放行一次探測，成功才恢復
+    def __init__(self, window=LLM_BREAKER_WINDOW, min_calls=LLM_BREAKER_MIN_CALLS,
+                 error_rate=LLM_BREAKER_ERROR_RATE, cooldown=LLM_BREAKER_COOLDOWN):
+        self.results = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe = None
+        self.trips = 0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = "half_open"
+                self.probe = threading.get_ident()
+                return True
+            return False
+
+    def cancel(self):
+        # 探測請求在送出前被限流或滿載拒絕時交還探測機會，下一個請求可立即再探測
+        with self.lock:
+            if self.state == "half_open" and self.probe == threading.get_ident():
+                self.state = "open"
+
+    def record(self, ok):
+        with self.lock:
+            if self.state == "half_open":
+                if ok:
+                    self.state = "closed"
+                    self.results.clear()
+                else:
+                    self._trip()
+                return
+            self.results.append(ok)
+            failures = self.results.count(False)
+            if len(self.results) >= self.min_calls and failures / len(self.results) >= self.error_rate:
+                self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self.results.clear()
+        print(f"⚠️ OpenAI 斷路器跳脫，{self.cooldown:g} 秒內直接回報失敗")
+
+class LLMGateway:
+    # 所有 chat completion 經此呼叫：速率限制、同時執行上限、相同 prompt 合併、斷路器
+    def __init__(self, bucket=None, breaker=None, max_inflight=LLM_MAX_INFLIGHT, max_wait=LLM_MAX_WAIT, timeout=LLM_TIMEOUT):
+        self.bucket = bucket or TokenBucket()
+        self.breaker = breaker or CircuitBreaker()
+        self.slots = threading.BoundedSemaphore(max_inflight)
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.queue_wait = 0.0
+        self.stats = {"calls": 0, "coalesced": 0, "failures": 0, "rate_limited": 0, "busy": 0, "circuit_open": 0}
+        metrics.register_collector(self._gauges)
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def _reject(self, reason):
+        self._count(reason)
+        metrics.inc("llm_rejected_total", reason=reason)
+        raise GatewayRejected(reason)
+
+    def complete(self, client, max_wait=None, on_send=None, **request):
+        # 回傳第一個 choice 的文字；被拒絕時丟出 GatewayRejected，呼叫失敗時丟出原本的例外
+        # on_send()：通過限流、確定送出請求前呼叫（合併到別人的呼叫時不會觸發）
+        key = hashlib.sha256(json.dumps(request, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+        while True:
+            with self.lock:
+                future = self.pending.get(key)
+                leader = future is None
+                if leader:
+                    future = self.pending[key] = Future()
+                else:
+                    self.stats["coalesced"] += 1
+            if leader:
+                break
+            try:
+                return future.result()
+            except GatewayRejected:
+                # 被拒絕的是帶頭呼叫自己的等待上限（例如背景預先產生不等待），改以本次的上限重新呼叫
+                continue
+        try:
+            result = self._call(client, self.max_wait if max_wait is None else max_wait, request, on_send)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def _call(self, client, max_wait, request, on_send=None):
+        if not self.breaker.allow():
+            self._reject("circuit_open")
+        t = time.monotonic()
+        try:
+            if self.bucket.acquire(max_wait) is None:
+                self._reject("rate_limited")
+            if not self.slots.acquire(timeout=max(0.0, max_wait - (time.monotonic() - t))):
+                self._reject("busy")
+        except GatewayRejected:
+            self.breaker.cancel()
+            raise
+        waited = time.monotonic() - t
+        metrics.observe("llm_queue_wait_seconds", waited)
+        with self.lock:
+            self.queue_wait += waited
+        ok = False
+        try:
+            self._count("calls")
+            if on_send:
+                on_send()
+            response = client.chat.completions.create(timeout=self.timeout, **request)
+            text = response.choices[0].message.content.strip()
+            ok = True
+        except Exception:
+            self._count("failures")
+            raise
+        finally:
+            self.slots.release()
+            # 任何結果（含非 Exception 的中斷）都要回報，半開狀態才不會卡住
+            self.breaker.record(ok)
+        return text
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["inflight_prompts"] = len(self.pending)
+            stats["avg_queue_wait_ms"] = round(self.queue_wait / stats["calls"] * 1000, 1) if stats["calls"] else 0.0
+        stats["breaker_state"] = self.breaker.state
+        stats["breaker_trips"] = self.breaker.trips
+        return stats
+
+    def _gauges(self):
+        stats = self.report()
+        state = stats.pop("breaker_state")
+        gauges = metrics.stats_series("llm_", stats, gauges=("inflight_prompts", "avg_queue_wait_ms"))
+        gauges += [("llm_breaker_state", {"state": s}, 1 if s == state else 0) for s in ("closed", "open", "half_open")]
+        return gauges
+
+gateway = LLMGateway()
@@ -0,0 +1,128 @@
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+EVENT_LOG = os.getenv("EVENT_LOG", "false").lower() == "true"
+PREFIX = "line_exam_"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_collectors = []
+
+# 每個事件的各階段耗時（僅在該事件的執行緒內有效）
+_event_stages = contextvars.ContextVar("event_stages", default=None)
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(BUCKETS)] += 1
+        h[-1] += seconds
+
+@contextmanager
+def timed(stage, **labels):
+    t = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        inc("stage_errors_total", stage=stage, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - t
+        observe("stage_seconds", elapsed, stage=stage, **labels)
+        stages = _event_stages.get()
+        if stages is not None:
+            stages.append((stage, round(elapsed * 1000, 2)))
+
+def register_collector(func):
+    # func() 回傳 [(name, labels, value), ...] 或 [(name, labels, value, type), ...]，type 預設為 gauge
+    _collectors.append(func)
+
+def stats_series(prefix, stats, gauges=()):
+    # 把各模組 report() 的統計轉成 collector 格式：gauges 以外的欄位都是只增不減的計數
+    return [(f"{prefix}{k}", {}, v, "gauge" if k in gauges else "counter") for k, v in stats.items()]
+
+@contextmanager
+def event_context(correlation_id=None, **fields):
+    cid = correlation_id or uuid.uuid4().hex
+    stages_token = _event_stages.set([])
+    t = time.perf_counter()
+    try:
+        yield cid
+    finally:
+        stages = _event_stages.get()
+        _event_stages.reset(stages_token)
+        if EVENT_LOG:
+            record = {"correlation_id": cid, "duration_ms": round((time.perf_counter() - t) * 1000, 2), "stages": stages}
+            record.update(fields)
+            print(json.dumps(record, ensure_ascii=False))
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+def render():
+    # Prometheus text exposition format
+    # 數值只存在本 process：gunicorn 多 worker 時每次 /metrics 只反映接到該請求的 worker，
+    # 需以 GUNICORN_WORKERS=1 執行，或由 Prometheus 分別抓取各 worker 後加總
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: list(v) for k, v in _histograms.items()}
+    lines = []
+    for name in sorted({k[0] for k in counters}):
+        lines.append(f"# TYPE {PREFIX}{name} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name:
+                lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    for name in sorted({k[0] for k in histograms}):
+        lines.append(f"# TYPE {PREFIX}{name} histogram")
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, count in zip(BUCKETS, h):
+                cumulative += count
+                lines.append(f"{PREFIX}{name}_bucket{_labels(labels, [('le', str(bound))])} {cumulative}")
+            cumulative += h[len(BUCKETS)]
+            lines.append(f"{PREFIX}{name}_bucket{_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{PREFIX}{name}_sum{_labels(labels)} {round(h[-1], 6)}")
+            lines.append(f"{PREFIX}{name}_count{_labels(labels)} {cumulative}")
+    collected, types = {}, {}
+    for func in _collectors:
+        try:
+            for name, labels, value, *kind in func():
+                collected.setdefault(name, []).append((_key(name, labels)[1], value))
+                types.setdefault(name, kind[0] if kind else "gauge")
+        except Exception as e:
+            print(f"⚠️ metrics collector 失敗：{e}")
+    for name in sorted(collected):
+        lines.append(f"# TYPE {PREFIX}{name} {types[name]}")
+        for labels, value in collected[name]:
+            lines.append(f"{PREFIX}{name}{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
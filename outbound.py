@@ -0,0 +1,187 @@
+import os
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from metrics import timed
+
+MAX_MESSAGES_PER_CALL = 5
+MAX_MULTICAST_RECIPIENTS = 500
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+SEND_RETRY_BASE = float(os.getenv("SEND_RETRY_BASE", "0.5"))
+
+_stats_lock = threading.Lock()
+outbound_stats = {
+    "messages": 0,
+    "reply_calls": 0,
+    "push_calls": 0,
+    "multicast_calls": 0,
+    "reply_fallbacks": 0,
+    "retries": 0,
+    "failures": 0
+}
+
+def _count(name, n=1):
+    with _stats_lock:
+        outbound_stats[name] += n
+
+def outbound_report():
+    with _stats_lock:
+        stats = dict(outbound_stats)
+    # 舊做法每則訊息各 push 一次
+    stats["pushes_saved"] = stats["messages"] - stats["push_calls"] - stats["multicast_calls"]
+    return stats
+
+class PooledHttpClient(RequestsHttpClient):
+    # 以共用 requests.Session 保持 keep-alive 連線，取代每次呼叫新建連線
+    def __init__(self, timeout=RequestsHttpClient.DEFAULT_TIMEOUT, pool_size=20):
+        super(PooledHttpClient, self).__init__(timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data, timeout=timeout or self.timeout)
+        return RequestsHttpResponse(response)
+
+def _retryable(e):
+    if isinstance(e, LineBotApiError):
+        return e.status_code == 429 or e.status_code >= 500
+    return isinstance(e, requests.RequestException)
+
+def send_with_retry(func, *args, **kwargs):
+    # 429 / 5xx / 連線錯誤時以指數退避加隨機抖動重試
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= SEND_MAX_RETRIES or not _retryable(e):
+                _count("failures")
+                raise
+            _count("retries")
+            time.sleep(random.uniform(0, SEND_RETRY_BASE * (2 ** attempt)))
+
+def send_reply(func, reply_token, messages):
+    # reply token 只能用一次：伺服器可能已收下的請求不可重送，以免 token 失效後又改 push 造成重複
+    # 回傳 "sent"（已送出）、"rejected"（確定未送達，可改用 push）或 "unknown"（可能已送達）
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        try:
+            func(reply_token, messages)
+            return "sent"
+        except LineBotApiError as e:
+            if e.status_code == 429 and attempt < SEND_MAX_RETRIES:
+                # 429 表示請求未被接受，token 仍有效，可安全重試
+                _count("retries")
+                time.sleep(random.uniform(0, SEND_RETRY_BASE * (2 ** attempt)))
+                continue
+            _count("failures")
+            return "unknown" if e.status_code >= 500 else "rejected"
+        except requests.ConnectTimeout:
+            # 連線都沒建立，請求一定未送出
+            _count("failures")
+            return "rejected"
+        except requests.RequestException:
+            # 逾時或連線中斷：無法確定伺服器是否已收下
+            _count("failures")
+            return "unknown"
+    return "rejected"
+
+def _chunks(messages):
+    for i in range(0, len(messages), MAX_MESSAGES_PER_CALL):
+        yield messages[i:i + MAX_MESSAGES_PER_CALL]
+
+class Outbox:
+    # 與 LineBotApi 相同介面：處理事件期間先收集訊息，flush 時依收件者合併
+    # 每次呼叫最多 5 則；事件本人優先用 reply token（免費），過期或用過才改 push
+    def __init__(self, line_bot_api, user_id=None, reply_token=None, received_at=None):
+        self.api = line_bot_api
+        self.user_id = user_id
+        self.reply_token = reply_token
+        self.received_at = received_at or time.time()
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+
+    def push_message(self, to, messages, **kwargs):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        with self.lock:
+            self.pending.setdefault(to, []).extend(messages)
+
+    def reply_message(self, reply_token, messages, **kwargs):
+        if reply_token == self.reply_token and self.user_id:
+            self.push_message(self.user_id, messages)
+        else:
+            with timed("line_send", api="reply"):
+                result = send_reply(self.api.reply_message, reply_token, messages)
+            _count("reply_calls")
+            _count("messages", len(messages) if isinstance(messages, (list, tuple)) else 1)
+            if result != "sent":
+                print(f"⚠️ reply 傳送失敗（{result}）")
+
+    def multicast(self, to, messages, **kwargs):
+        # 每次 multicast 最多 500 位收件者、5 則訊息；回傳未能送達的收件者，不中斷其餘批次
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        to = list(to)
+        failed = []
+        for i in range(0, len(to), MAX_MULTICAST_RECIPIENTS):
+            recipients = to[i:i + MAX_MULTICAST_RECIPIENTS]
+            for chunk in _chunks(messages):
+                try:
+                    with timed("line_send", api="multicast"):
+                        send_with_retry(self.api.multicast, recipients, chunk, retry_key=str(uuid.uuid4()))
+                except Exception as e:
+                    print(f"⚠️ multicast 傳送失敗（{len(recipients)} 位）：{e}")
+                    failed.extend(recipients)
+                    break
+                _count("multicast_calls")
+                _count("messages", len(chunk) * len(recipients))
+        return failed
+
+    def _reply_usable(self):
+        return self.reply_token and time.time() - self.received_at < REPLY_TOKEN_TTL
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, OrderedDict()
+        for to, messages in pending.items():
+            _count("messages", len(messages))
+            for chunk in _chunks(messages):
+                if to == self.user_id and self._reply_usable():
+                    token, self.reply_token = self.reply_token, None
+                    with timed("line_send", api="reply"):
+                        result = send_reply(self.api.reply_message, token, chunk)
+                    _count("reply_calls")
+                    if result == "sent":
+                        continue
+                    if result == "unknown":
+                        # 可能已送達：不改用 push，避免學生收到重複訊息
+                        print(f"⚠️ reply 結果不明，不再以 push 重送 {to}")
+                        continue
+                    # token 失效或確定未送出時改用 push（token 已清除，之後的訊息也直接 push）
+                    _count("reply_fallbacks")
+                try:
+                    with timed("line_send", api="push"):
+                        send_with_retry(self.api.push_message, to, chunk, retry_key=str(uuid.uuid4()))
+                    _count("push_calls")
+                except Exception as e:
+                    print(f"⚠️ 訊息傳送失敗 {to}：{e}")
@@ -0,0 +1,108 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+PREFETCH_HOURLY_BUDGET = int(os.getenv("PREFETCH_HOURLY_BUDGET", "300"))
+PREFETCH_MAX_PENDING = int(os.getenv("PREFETCH_MAX_PENDING", "100"))
+PREFETCH_WAIT_TIMEOUT = float(os.getenv("PREFETCH_WAIT_TIMEOUT", "15"))
+
+class ExplanationPrefetcher:
+    # 測驗結束時於背景預先產生錯題解析，結果寫入 explanation_cache
+    # 全域同時執行數由 thread pool 大小限制，每小時最多呼叫 OpenAI hourly_budget 次（只計算實際送出的呼叫）
+    def __init__(self, generate, key_func, is_cached, concurrency=PREFETCH_CONCURRENCY,
+                 hourly_budget=PREFETCH_HOURLY_BUDGET, max_pending=PREFETCH_MAX_PENDING):
+        self.generate = generate
+        self.key_func = key_func
+        self.is_cached = is_cached
+        self.hourly_budget = hourly_budget
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="prefetch")
+        self.inflight = {}
+        self.spent = deque()
+        self.lock = threading.Lock()
+        self.stats = {"scheduled": 0, "cached": 0, "over_budget": 0, "dropped": 0, "completed": 0, "failed": 0, "joined": 0, "preempted": 0}
+        metrics.register_collector(lambda: metrics.stats_series("prefetch_", self.report(), gauges=("inflight", "budget_used")))
+
+    def _has_budget(self, now):
+        while self.spent and now - self.spent[0] > 3600:
+            self.spent.popleft()
+        return len(self.spent) < self.hourly_budget
+
+    def _charge(self):
+        # 由 gateway 在實際送出請求時呼叫；被限流拒絕的預先產生不扣額度
+        with self.lock:
+            self.spent.append(time.time())
+
+    def schedule(self, client, items):
+        # items：[(question, student_answer, repo), ...]
+        if not PREFETCH_ENABLED:
+            return 0
+        scheduled = 0
+        for question, student_answer, repo in items:
+            key = self.key_func(question, student_answer)
+            cached = self.is_cached(repo, key)
+            with self.lock:
+                if cached:
+                    self.stats["cached"] += 1
+                    continue
+                if key in self.inflight:
+                    continue
+                if len(self.inflight) >= self.max_pending:
+                    self.stats["dropped"] += 1
+                    continue
+                if not self._has_budget(time.time()):
+                    self.stats["over_budget"] += 1
+                    continue
+                future = self.executor.submit(self._run, client, question, student_answer, repo)
+                self.inflight[key] = future
+                self.stats["scheduled"] += 1
+            future.add_done_callback(lambda f, key=key: self._done(key))
+            scheduled += 1
+        return scheduled
+
+    def _run(self, client, question, student_answer, repo):
+        # 排隊期間額度可能已被其他背景呼叫用完，執行前再確認一次
+        with self.lock:
+            if not self._has_budget(time.time()):
+                self.stats["over_budget"] += 1
+                return None
+        with metrics.timed("prefetch", subject=repo):
+            explanation = self.generate(client, question, student_answer, repo, prefetch=True, on_send=self._charge)
+        with self.lock:
+            self.stats["completed" if explanation else "failed"] += 1
+        return explanation
+
+    def _done(self, key):
+        with self.lock:
+            self.inflight.pop(key, None)
+
+    def join(self, key):
+        # 學生查詢時若同一份解析正在背景產生，直接等待結果而不重複呼叫
+        with self.lock:
+            future = self.inflight.get(key)
+        if future is None:
+            return None
+        if future.cancel():
+            # 還在排隊、尚未開始：取消背景工作，由學生的請求直接呼叫，不必等前面的預先產生
+            with self.lock:
+                self.stats["preempted"] += 1
+            return None
+        try:
+            result = future.result(timeout=PREFETCH_WAIT_TIMEOUT)
+        except Exception:
+            return None
+        with self.lock:
+            self.stats["joined"] += 1
+        return result
+
+    def report(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats["inflight"] = len(self.inflight)
+            stats["budget_used"] = len(self.spent)
+        return stats
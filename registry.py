@@ -0,0 +1,315 @@
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from metrics import timed
+import shared_state
+
+REGISTRY_DB = os.getenv("REGISTRY_DB", "registry.db")
+REGISTRY_COMPACT_EVERY = int(os.getenv("REGISTRY_COMPACT_EVERY", "500"))
+# 多個 worker 共用名單時，檢查其他 process 是否已寫入的最短間隔（秒）
+REGISTRY_SYNC_INTERVAL = float(os.getenv("REGISTRY_SYNC_INTERVAL", "1"))
+WHITELIST_FILE = "whitelist.json"
+PENDING_FILE = "pending_register.json"
+KINDS = ("whitelist", "pending")
+
+# 舊版 whitelist.json 使用中文欄位
+KEY_MAP = {
+    "學號": "student_id",
+    "姓名": "name",
+    "學校": "school",
+    "起始日": "start_date",
+    "結束日": "end_date",
+    "LINE_ID": "line_id"
+}
+
+def normalize_entry(entry, line_id=None):
+    data = {KEY_MAP.get(k, k): v for k, v in entry.items()}
+    data["line_id"] = data.get("line_id") or line_id
+    return data
+
+class SQLiteStore:
+    # 預設：本機 SQLite 檔案；同機多個 worker 以 PRAGMA data_version 得知其他 process 的寫入
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT NOT NULL, line_id TEXT NOT NULL, student_id TEXT, data TEXT NOT NULL, "
+            "PRIMARY KEY (kind, line_id))"
+        )
+        self.conn.commit()
+
+    def load(self):
+        for kind, line_id, data in self.conn.execute("SELECT kind, line_id, data FROM entries"):
+            yield kind, json.loads(data)
+
+    def apply(self, ops):
+        # 回傳 (寫入前版本, 寫入後版本)：在同一筆寫入交易內讀取，其他 process 無法插入其間
+        # 本連線自己的寫入不會改變 data_version，因此兩者相同
+        with self.conn:
+            self.conn.execute("BEGIN IMMEDIATE")
+            version = self.version()
+            for op, kind, value in ops:
+                if op == "put":
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO entries (kind, line_id, student_id, data) VALUES (?, ?, ?, ?)",
+                        (kind, value["line_id"], value.get("student_id"), json.dumps(value, ensure_ascii=False))
+                    )
+                else:
+                    self.conn.execute("DELETE FROM entries WHERE kind = ? AND line_id = ?", (kind, value))
+        return version, version
+
+    def version(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def compact(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        self.conn.execute("VACUUM")
+
+class SharedStore:
+    # SHARED_STATE 為 redis 等跨機器後端時，名單也存放於該後端；每次寫入後以 compare-and-set 遞增版本計數
+    def __init__(self, backend):
+        self.backend = backend
+        self.path = getattr(backend, "url", type(backend).__name__)
+
+    def load(self):
+        for kind in KINDS:
+            for _, data in self.backend.items(f"registry:{kind}"):
+                yield kind, json.loads(data)
+
+    def apply(self, ops):
+        batch = []
+        for op, kind, value in ops:
+            if op == "put":
+                batch.append(("set", f"registry:{kind}", value["line_id"], json.dumps(value, ensure_ascii=False).encode("utf-8")))
+            else:
+                batch.append(("del", f"registry:{kind}", value))
+        self.backend.write_batch(batch)
+        # 先寫資料再遞增計數：遞增前的值若不是上次看到的，表示其間有其他 worker 寫入
+        while True:
+            raw, version = self.backend.get("registry_meta", "version")
+            before = self._parse(raw)
+            if self.backend.cas("registry_meta", "version", version, str(before + 1).encode("ascii")):
+                return before, before + 1
+
+    @staticmethod
+    def _parse(raw):
+        # 舊版存放隨機字串，視為 0
+        return int(raw) if raw and raw.isdigit() else 0
+
+    def version(self):
+        return self._parse(self.backend.get("registry_meta", "version")[0])
+
+    def compact(self):
+        pass
+
+class Registry:
+    # 白名單與待審核資料常駐記憶體，並以 LINE ID 與學號雙索引；寫入以交易落地
+    # 讀取前（最多每 REGISTRY_SYNC_INTERVAL 秒一次）檢查其他 worker 是否已寫入，有則重新載入
+    def __init__(self, path=REGISTRY_DB, store=None):
+        self.store = store or SQLiteStore(path)
+        self.path = self.store.path
+        self.lock = threading.RLock()
+        self.writes = 0
+        self.listeners = []
+        self.reload()
+
+    def subscribe(self, listener):
+        # listener(ops)：本 process 寫入後收到該次的 ops；重新載入整份名單時收到 None
+        self.listeners.append(listener)
+
+    def _notify(self, ops):
+        for listener in self.listeners:
+            try:
+                listener(ops)
+            except Exception as e:
+                print(f"⚠️ registry listener 失敗：{e}")
+
+    def reload(self):
+        with self.lock:
+            self.entries = {kind: {} for kind in KINDS}
+            self.by_student = {kind: {} for kind in KINDS}
+            self.seen_version = self.store.version()
+            self.checked_at = time.time()
+            for kind, entry in self.store.load():
+                if kind in self.entries:
+                    self._index(kind, entry)
+            self._notify(None)
+
+    def sync(self):
+        now = time.time()
+        if now - self.checked_at < REGISTRY_SYNC_INTERVAL:
+            return
+        with self.lock:
+            self.checked_at = now
+            if self.store.version() != self.seen_version:
+                self.reload()
+
+    def _apply(self, ops):
+        # ops：[("put", kind, entry) | ("delete", kind, line_id)]，寫入成功後才更新記憶體索引
+        before, after = self.store.apply(ops)
+        if before != self.seen_version:
+            # 其他 worker 已先寫入：整份重新載入即包含本次變更
+            self.reload()
+            self._committed(len(ops))
+            return
+        self.seen_version = after
+        for op, kind, value in ops:
+            if op == "put":
+                self._unindex(kind, value["line_id"])
+                self._index(kind, value)
+            else:
+                self._unindex(kind, value)
+        self._committed(len(ops))
+        self._notify(ops)
+
+    def _index(self, kind, entry):
+        self.entries[kind][entry["line_id"]] = entry
+        if entry.get("student_id"):
+            self.by_student[kind][entry["student_id"]] = entry["line_id"]
+
+    def _unindex(self, kind, line_id):
+        entry = self.entries[kind].pop(line_id, None)
+        if entry and self.by_student[kind].get(entry.get("student_id")) == line_id:
+            del self.by_student[kind][entry["student_id"]]
+        return entry
+
+    def _committed(self, count=1):
+        self.writes += count
+        if REGISTRY_COMPACT_EVERY and self.writes >= REGISTRY_COMPACT_EVERY:
+            self.compact()
+
+    def get(self, kind, line_id):
+        self.sync()
+        return self.entries[kind].get(line_id)
+
+    def __contains__(self, line_id):
+        self.sync()
+        return line_id in self.entries["whitelist"]
+
+    def find(self, kind, target):
+        # 可用 LINE ID 或學號查詢，O(1)
+        self.sync()
+        with timed("whitelist_lookup", kind=kind), self.lock:
+            if target in self.entries[kind]:
+                return self.entries[kind][target]
+            line_id = self.by_student[kind].get(target)
+            return self.entries[kind].get(line_id) if line_id else None
+
+    def all(self, kind):
+        self.sync()
+        with self.lock:
+            return list(self.entries[kind].values())
+
+    def put(self, kind, entry):
+        entry = normalize_entry(entry)
+        with self.lock:
+            self._apply([("put", kind, entry)])
+        return entry
+
+    def remove(self, kind, target):
+        with self.lock:
+            entry = self.find(kind, target)
+            if not entry:
+                return None
+            self._apply([("delete", kind, entry["line_id"])])
+            return entry
+
+    def approve(self, target):
+        # 待審核 → 白名單在同一筆交易內完成
+        with self.lock:
+            entry = self.find("pending", target)
+            if not entry:
+                return None
+            self._apply([("delete", "pending", entry["line_id"]), ("put", "whitelist", entry)])
+            return entry
+
+    def put_many(self, kind, entries):
+        # 批次寫入在同一筆交易內完成
+        entries = [normalize_entry(entry) for entry in entries]
+        with self.lock:
+            if entries:
+                self._apply([("put", kind, entry) for entry in entries])
+        return entries
+
+    def approve_many(self, targets):
+        # 回傳 (已審核的 entries, 查無的 targets)；所有搬移在同一筆交易內完成
+        with self.lock:
+            approved, missing, seen = [], [], set()
+            for target in targets:
+                entry = self.find("pending", target)
+                if not entry:
+                    missing.append(target)
+                elif entry["line_id"] not in seen:
+                    seen.add(entry["line_id"])
+                    approved.append(entry)
+            ops = []
+            for entry in approved:
+                ops += [("delete", "pending", entry["line_id"]), ("put", "whitelist", entry)]
+            if ops:
+                self._apply(ops)
+            return approved, missing
+
+    def compact(self):
+        with self.lock:
+            self.writes = 0
+            try:
+                self.store.compact()
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ registry 壓縮失敗：{e}")
+
+    def import_json(self, path, kind):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        entries, skipped = [], []
+        for key, value in data.items():
+            entry = normalize_entry(value, key) if isinstance(value, dict) else None
+            # 缺少 LINE ID 的舊資料無法建立索引，略過並回報，不中斷整批匯入
+            if not entry or not entry.get("line_id"):
+                skipped.append(str(key) or (value.get("學號") if isinstance(value, dict) else "") or "?")
+                continue
+            entries.append(entry)
+        if skipped:
+            print(f"⚠️ {path} 略過 {len(skipped)} 筆格式錯誤或缺少 LINE ID 的資料：{'、'.join(skipped)}")
+        with self.lock:
+            if entries:
+                self._apply([("put", kind, entry) for entry in entries])
+        return len(entries)
+
+    def is_empty(self):
+        return not any(self.entries[kind] for kind in KINDS)
+
+_registry = None
+_registry_lock = threading.Lock()
+
+def get_registry():
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            # 跨機器共用（redis）時名單一併存放於共用後端，否則使用本機 SQLite 檔案
+            store = SharedStore(shared_state.get_backend()) if shared_state.SHARED_STATE.startswith("redis://") else None
+            _registry = Registry(store=store)
+            if _registry.is_empty():
+                # 首次啟動時自動匯入既有 JSON
+                _registry.import_json(WHITELIST_FILE, "whitelist")
+                _registry.import_json(PENDING_FILE, "pending")
+        return _registry
+
+if __name__ == "__main__":
+    # 用法：python registry.py import [whitelist.json] [pending_register.json]
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("用法：python registry.py import [whitelist.json] [pending_register.json]")
+        sys.exit(1)
+    reg = Registry()
+    w = reg.import_json(sys.argv[2] if len(sys.argv) > 2 else WHITELIST_FILE, "whitelist")
+    p = reg.import_json(sys.argv[3] if len(sys.argv) > 3 else PENDING_FILE, "pending")
+    reg.compact()
+    print(f"✅ 已匯入白名單 {w} 筆、待審核 {p} 筆至 {reg.path}")
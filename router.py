@@ -0,0 +1,160 @@
+import difflib
+from collections import defaultdict
+from metrics import inc, timed
+from session_store import SessionConflict
+
+# session 寫回發生版本衝突時，重新讀取並處理同一則訊息的次數上限
+CONFLICT_RETRIES = 3
+
+# 單一字母作答的所有寫法（含全形、小寫、結尾句點），查表 O(1)
+ANSWER_FORMS = {}
+for _letter, _full in zip("ABCD", "ＡＢＣＤ"):
+    for _form in (_letter, _letter.lower(), _full, _full.lower()):
+        for _suffix in ("", ".", "．"):
+            ANSWER_FORMS[_form + _suffix] = _letter
+
+class MessageContext:
+    __slots__ = ("event", "user_id", "text", "args", "line_bot_api", "client", "user_sessions", "registration_buffer", "session")
+
+    def __init__(self, event, user_id, text, line_bot_api, client, user_sessions, registration_buffer):
+        self.event = event
+        self.user_id = user_id
+        self.text = text
+        self.args = text.split()
+        self.line_bot_api = line_bot_api
+        self.client = client
+        self.user_sessions = user_sessions
+        self.registration_buffer = registration_buffer
+        self.session = None
+
+class Route:
+    __slots__ = ("name", "handler", "admin_only", "exact", "parts", "before_registration")
+
+    def __init__(self, name, handler, admin_only=False, exact=False, parts=None, before_registration=False):
+        self.name = name
+        self.handler = handler
+        self.admin_only = admin_only
+        self.exact = exact
+        self.parts = parts
+        self.before_registration = before_registration
+
+class CommandTrie:
+    # 指令前綴樹：一次走訪輸入字元即可找出所有符合的前綴，取最長且條件成立者
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, route):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node.setdefault(None, []).append(route)
+
+    def match(self, text, accept):
+        node = self.root
+        found = []
+        for i, ch in enumerate(text):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found.append((i + 1, node[None]))
+        for end, routes in reversed(found):
+            for route in routes:
+                if route.exact and end != len(text):
+                    continue
+                if accept(route):
+                    return route
+        return None
+
+class SubjectIndex:
+    # 預先建立科目名稱的字元索引，只對有共同字元的科目計算 difflib 相似度（與逐一比對結果相同）
+    def __init__(self, subjects, alias, cutoff=0.4):
+        self.subjects = subjects
+        self.alias = alias
+        self.cutoff = cutoff
+        self.names = list(subjects)
+        self.index = defaultdict(list)
+        for i, name in enumerate(self.names):
+            for ch in set(name):
+                self.index[ch].append(i)
+        # ratio = 2M / (len(text) + len(name)) 且 M <= len(name)，超過此長度不可能達到門檻
+        self.max_len = int(max(len(name) for name in self.names) * (2 / cutoff - 1))
+
+    def match(self, text):
+        if text in self.subjects:
+            return text
+        if text in self.alias:
+            return self.alias[text]
+        if not text or len(text) > self.max_len:
+            return None
+        # 沒有任何共同字元的科目相似度為 0，不會入選
+        shortlist = {i for ch in set(text) for i in self.index.get(ch, ())}
+        best = difflib.get_close_matches(text, [self.names[i] for i in sorted(shortlist)], n=1, cutoff=self.cutoff)
+        return best[0] if best else None
+
+class Router:
+    # 啟動時編譯一次；每則訊息只走一次前綴樹加上常數次查表
+    def __init__(self, subjects, alias, is_admin):
+        self.commands = CommandTrie()
+        self.subject_index = SubjectIndex(subjects, alias)
+        self.is_admin = is_admin
+        self.on_registration = None
+        self.on_answer = None
+        self.on_subject = None
+
+    def command(self, prefix, handler, **options):
+        self.commands.add(prefix, Route(prefix.strip(), handler, **options))
+
+    def registration(self, handler):
+        self.on_registration = handler
+
+    def answer(self, handler):
+        self.on_answer = handler
+
+    def subject(self, handler):
+        self.on_subject = handler
+
+    def _accept(self, ctx):
+        def accept(route):
+            if route.parts is not None and len(ctx.args) != route.parts:
+                return False
+            return not route.admin_only or self.is_admin(ctx.user_id)
+        return accept
+
+    def resolve(self, ctx):
+        # 回傳 (路由名稱, 處理函式, 額外參數)；找不到時名稱為 None
+        route = self.commands.match(ctx.text, self._accept(ctx))
+        if route and route.before_registration:
+            return route.name, route.handler, ()
+        if ctx.user_id in ctx.registration_buffer:
+            return "register", self.on_registration, ()
+        if route:
+            return route.name, route.handler, ()
+
+        ctx.session = ctx.user_sessions.get(ctx.user_id)
+        if ctx.session is not None and not ctx.session.completed:
+            # 作答中：不做科目比對，直接視為作答
+            return "answer", self.on_answer, (ANSWER_FORMS.get(ctx.text),)
+        subject = self.subject_index.match(ctx.text)
+        if subject:
+            return "subject", self.on_subject, (subject,)
+        return None, None, ()
+
+    def dispatch(self, ctx):
+        for attempt in range(CONFLICT_RETRIES + 1):
+            with timed("route"):
+                name, handler, args = self.resolve(ctx)
+            if not handler:
+                break
+            try:
+                with timed("handle", command=name):
+                    handler(ctx, *args)
+                break
+            except SessionConflict:
+                # 另一個 worker 已更新此使用者的 session：以最新狀態重新路由
+                inc("session_conflicts_total", command=name)
+                if attempt >= CONFLICT_RETRIES:
+                    raise
+                ctx.session = None
+        inc("events_total", command=name or "unmatched")
+        return name
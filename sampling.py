@@ -0,0 +1,156 @@
+import os
+import random
+import threading
+from array import array
+from collections import OrderedDict
+from metrics import inc
+from shared_state import get_backend
+
+EXAM_NUM_QUESTIONS = int(os.getenv("EXAM_NUM_QUESTIONS", "5"))
+# 未做過 > 答錯過 > 已答對，先把題庫做過一輪，再加強複習錯題
+SAMPLING_WEIGHT_UNSEEN = int(os.getenv("SAMPLING_WEIGHT_UNSEEN", "8"))
+SAMPLING_WEIGHT_WRONG = int(os.getenv("SAMPLING_WEIGHT_WRONG", "4"))
+SAMPLING_WEIGHT_SEEN = int(os.getenv("SAMPLING_WEIGHT_SEEN", "1"))
+# 快取的樹只需涵蓋正在測驗中的學生，每棵約 4 bytes × 題數
+SAMPLING_CACHE_TREES = int(os.getenv("SAMPLING_CACHE_TREES", "64"))
+# 作答紀錄在最後一次作答後保留的秒數，逾期的學生重新開始記錄
+SAMPLING_TTL = int(os.getenv("SAMPLING_TTL", str(90 * 24 * 60 * 60)))
+
+class Fenwick:
+    # 權重前綴和樹：單點更新與依累積權重找索引皆為 O(log n)
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.tree = array("i", [0]) + array("i", weights)
+        for i in range(1, self.n + 1):
+            j = i + (i & -i)
+            if j <= self.n:
+                self.tree[j] += self.tree[i]
+        self.total = sum(weights)
+        self.top = 1 << self.n.bit_length() if self.n else 0
+
+    def add(self, index, delta):
+        self.total += delta
+        i = index + 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def find(self, target):
+        # 回傳累積權重第一次超過 target 的索引（0 起算）
+        pos, step = 0, self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] <= target:
+                pos = nxt
+                target -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+class UserProgress:
+    # 每位學生、每個題庫一組 seen / wrong 位元集合（每題 2 bits），存放於 shared_state 後端
+    __slots__ = ("size", "seen", "wrong", "version")
+
+    def __init__(self, size, raw=None, version=0):
+        nbytes = (size + 7) // 8
+        self.size = size
+        self.version = version
+        if raw and len(raw) == 2 * nbytes:
+            self.seen, self.wrong = bytearray(raw[:nbytes]), bytearray(raw[nbytes:])
+        else:
+            # 題庫題數變動時重新開始記錄
+            self.seen, self.wrong = bytearray(nbytes), bytearray(nbytes)
+
+    def dumps(self):
+        return bytes(self.seen) + bytes(self.wrong)
+
+    @staticmethod
+    def _get(bits, i):
+        return bits[i >> 3] >> (i & 7) & 1
+
+    @staticmethod
+    def _set(bits, i, value):
+        if value:
+            bits[i >> 3] |= 1 << (i & 7)
+        else:
+            bits[i >> 3] &= ~(1 << (i & 7)) & 0xFF
+
+    def weight(self, i):
+        if self._get(self.wrong, i):
+            return SAMPLING_WEIGHT_WRONG
+        if self._get(self.seen, i):
+            return SAMPLING_WEIGHT_SEEN
+        return SAMPLING_WEIGHT_UNSEEN
+
+    def mark(self, i, correct):
+        self._set(self.seen, i, 1)
+        self._set(self.wrong, i, not correct)
+
+class AdaptiveSampler:
+    # 未做過的題目優先、最近答錯的題目加權；每位學生的 Fenwick 樹建一次後快取，
+    # 之後每次抽 k 題（不重複）與每題作答結果的更新都只要 O(log n)
+    def __init__(self, backend=None, cache_trees=SAMPLING_CACHE_TREES):
+        self.backend = backend
+        self.cache_trees = cache_trees
+        self.trees = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _backend(self):
+        return self.backend or get_backend()
+
+    def _load(self, user_id, repo, size):
+        raw, version = self._backend().get("sampling", f"{user_id}:{repo}")
+        return UserProgress(size, raw, version)
+
+    def _tree(self, user_id, repo, progress):
+        # 快取的樹與後端版本一致才沿用（其他 worker 更新過就重建）
+        key = (user_id, repo)
+        cached = self.trees.get(key)
+        if cached and cached[0] == progress.version and cached[1].n == progress.size:
+            self.trees.move_to_end(key)
+            return cached[1]
+        tree = Fenwick([progress.weight(i) for i in range(progress.size)])
+        self.trees[key] = (progress.version, tree)
+        self.trees.move_to_end(key)
+        while len(self.trees) > self.cache_trees:
+            self.trees.popitem(last=False)
+        inc("sampling_tree_builds_total", subject=repo)
+        return tree
+
+    def draw(self, user_id, repo, size, k=EXAM_NUM_QUESTIONS):
+        k = min(k, size)
+        progress = self._load(user_id, repo, size)
+        with self.lock:
+            tree = self._tree(user_id, repo, progress)
+            picked = []
+            for _ in range(k):
+                if tree.total <= 0:
+                    break
+                i = tree.find(random.randrange(tree.total))
+                w = progress.weight(i)
+                tree.add(i, -w)
+                picked.append((i, w))
+            # 抽完還原權重
+            for i, w in picked:
+                tree.add(i, w)
+        return [i for i, _ in picked]
+
+    def record(self, user_id, repo, size, results):
+        # results：[(題庫索引, 是否答對), ...]；以 compare-and-set 寫回，衝突時重讀再套用
+        backend = self._backend()
+        key = f"{user_id}:{repo}"
+        while True:
+            progress = self._load(user_id, repo, size)
+            before = [(i, progress.weight(i)) for i, _ in results]
+            for i, correct in results:
+                progress.mark(i, correct)
+            if backend.cas("sampling", key, progress.version, progress.dumps(), ttl=SAMPLING_TTL):
+                break
+        with self.lock:
+            cached = self.trees.get((user_id, repo))
+            if cached and cached[0] == progress.version and cached[1].n == size:
+                tree = cached[1]
+                for i, old in before:
+                    tree.add(i, progress.weight(i) - old)
+                self.trees[(user_id, repo)] = (progress.version + 1, tree)
+
+sampler = AdaptiveSampler()
@@ -0,0 +1,192 @@
+import json
+import os
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+SESSION_IDLE_TTL = int(os.getenv("SESSION_IDLE_TTL", str(2 * 60 * 60)))
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "5000"))
+ANSWER_LETTERS = "ABCD"
+
+class ExamSession:
+    # 只存題庫索引與壓縮後的作答（1 byte/題），題目本體共用 bank_cache 的同一份題庫
+    # bank_version 記錄開始測驗時的題庫版本，題庫中途更新時據此判斷索引已不再對應原本的題目
+    __slots__ = ("repo", "subject", "bank", "bank_version", "indices", "answers", "current", "explain_count", "completed", "touched", "version")
+
+    def __init__(self, repo, subject, bank, indices, bank_version=None):
+        self.repo = repo
+        self.subject = subject
+        self.bank = bank
+        self.bank_version = bank_version
+        self.indices = array("I", indices)
+        self.answers = bytearray(len(indices))
+        self.current = 0
+        self.explain_count = 0
+        self.completed = False
+        self.touched = time.time()
+        self.version = 0
+
+    @property
+    def size(self):
+        return len(self.indices)
+
+    def question(self, pos):
+        return self.bank[self.indices[pos]]
+
+    def answer(self, pos):
+        code = self.answers[pos]
+        return ANSWER_LETTERS[code - 1] if code else None
+
+    def record(self, letter):
+        self.answers[self.current] = ANSWER_LETTERS.index(letter) + 1
+        self.current += 1
+
+    def nbytes(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.indices) + sys.getsizeof(self.answers)
+
+    def dumps(self):
+        # 跨 process 共用時只序列化索引與作答，題目本體依 repo 由各 worker 的 bank_cache 取得
+        return json.dumps({
+            "r": self.repo,
+            "s": self.subject,
+            "i": list(self.indices),
+            "v": self.bank_version,
+            "a": self.answers.hex(),
+            "c": self.current,
+            "e": self.explain_count,
+            "d": self.completed
+        }, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    @classmethod
+    def loads(cls, raw, bank_loader):
+        data = json.loads(raw)
+        session = cls(data["r"], data["s"], bank_loader(data["r"]), data["i"], data.get("v"))
+        session.answers = bytearray.fromhex(data["a"])
+        session.current = data["c"]
+        session.explain_count = data["e"]
+        session.completed = data["d"]
+        return session
+
+class SessionConflict(Exception):
+    # 另一個 worker 已先更新同一位使用者的 session
+    pass
+
+class SessionStore:
+    # 以最後存取時間排序；閒置超過 TTL 或超過上限時淘汰最舊的 session
+    def __init__(self, idle_ttl=SESSION_IDLE_TTL, max_entries=SESSION_MAX_ENTRIES):
+        self.idle_ttl = idle_ttl
+        self.max_entries = max_entries
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        self.evicted = 0
+
+    def _evict(self, now):
+        while self.sessions:
+            user_id, session = next(iter(self.sessions.items()))
+            if len(self.sessions) > self.max_entries or now - session.touched > self.idle_ttl:
+                del self.sessions[user_id]
+                self.evicted += 1
+            else:
+                break
+
+    def get(self, user_id):
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            session = self.sessions.get(user_id)
+            if session is not None:
+                session.touched = now
+                self.sessions.move_to_end(user_id)
+            return session
+
+    def put(self, user_id, session):
+        now = time.time()
+        with self.lock:
+            session.touched = now
+            self.sessions[user_id] = session
+            self.sessions.move_to_end(user_id)
+            self._evict(now)
+
+    def save(self, user_id, session):
+        # 單一 process 內同一使用者的事件已由 dispatcher 依序處理，直接寫回即可
+        self.put(user_id, session)
+
+    def pop(self, user_id, default=None):
+        with self.lock:
+            return self.sessions.pop(user_id, default)
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def memory_report(self):
+        with self.lock:
+            self._evict(time.time())
+            sessions = list(self.sessions.items())
+        total = sys.getsizeof(self.sessions) + sum(sys.getsizeof(k) + s.nbytes() for k, s in sessions)
+        active = sum(1 for _, s in sessions if not s.completed)
+        return {
+            "sessions": len(sessions),
+            "active": active,
+            "bytes": total,
+            "bytes_per_session": round(total / len(sessions)) if sessions else 0,
+            "evicted": self.evicted
+        }
+
+class SharedSessionStore:
+    # 介面同 SessionStore，session 存放於 shared_state 後端，供多個 worker process 共用
+    # save 以版本號 compare-and-set，版本不符時丟出 SessionConflict 由 router 重新處理該事件
+    def __init__(self, backend, bank_loader, idle_ttl=SESSION_IDLE_TTL):
+        self.backend = backend
+        self.bank_loader = bank_loader
+        self.idle_ttl = idle_ttl
+        self.conflicts = 0
+
+    def get(self, user_id):
+        raw, version = self.backend.get("session", user_id)
+        if raw is None:
+            return None
+        session = ExamSession.loads(raw, self.bank_loader)
+        session.version = version
+        return session
+
+    def put(self, user_id, session):
+        while True:
+            _, version = self.backend.get("session", user_id)
+            if self.backend.cas("session", user_id, version, session.dumps(), self.idle_ttl):
+                session.version = version + 1
+                return
+
+    def save(self, user_id, session):
+        if not self.backend.cas("session", user_id, session.version, session.dumps(), self.idle_ttl):
+            self.conflicts += 1
+            raise SessionConflict(user_id)
+        session.version += 1
+        session.touched = time.time()
+
+    def pop(self, user_id, default=None):
+        session = self.get(user_id)
+        self.backend.delete("session", user_id)
+        return session if session is not None else default
+
+    def __contains__(self, user_id):
+        return self.backend.get("session", user_id)[0] is not None
+
+    def __len__(self):
+        return self.backend.count("session")
+
+    def memory_report(self):
+        sessions = self.backend.items("session")
+        total = sum(len(k) + len(v) for k, v in sessions)
+        active = sum(1 for _, v in sessions if not json.loads(v)["d"])
+        return {
+            "sessions": len(sessions),
+            "active": active,
+            "bytes": total,
+            "bytes_per_session": round(total / len(sessions)) if sessions else 0,
+            "conflicts": self.conflicts
+        }
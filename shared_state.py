@@ -0,0 +1,418 @@
+import fcntl
+import os
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+# 跨 worker / 跨機器共用狀態（session、註冊暫存、名單、事件去重）的後端
+# SHARED_STATE=memory（預設，僅限單一 process）
+# SHARED_STATE=sqlite:///path/to/state.db（同一台機器多個 worker）
+# SHARED_STATE=redis://host:6379/0（多台機器）
+SHARED_STATE = os.getenv("SHARED_STATE", "memory")
+# SQLite 後端每寫入幾次清除一次過期資料
+SQLITE_PURGE_EVERY = int(os.getenv("SQLITE_PURGE_EVERY", "1000"))
+# 記憶體後端只在讀到時才移除過期資料，每寫入幾次整體清除一次，避免不再讀取的鍵一直佔用記憶體
+MEMORY_PURGE_EVERY = int(os.getenv("MEMORY_PURGE_EVERY", "1000"))
+
+# 所有後端提供相同介面，值一律為 bytes，version 為 0 表示不存在：
+#   get(ns, key) -> (value, version)
+#   cas(ns, key, expected_version, value, ttl=None) -> bool（value 為 None 時刪除）
+#   add_if_absent(ns, key, value, ttl=None) -> bool
+#   delete(ns, key)
+#   items(ns) -> [(key, value), ...]
+#   write_batch([("set", ns, key, value) | ("del", ns, key), ...])（原子寫入）
+#   count(ns) -> int
+
+class InProcessBackend:
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def _written(self, now):
+        self.writes += 1
+        if self.writes % MEMORY_PURGE_EVERY == 0:
+            for k in [k for k, item in self.data.items() if item[2] and item[2] < now]:
+                del self.data[k]
+
+    def _live(self, k, now):
+        item = self.data.get(k)
+        if item and item[2] and item[2] < now:
+            del self.data[k]
+            return None
+        return item
+
+    def get(self, ns, key):
+        with self.lock:
+            item = self._live((ns, key), time.time())
+            return (item[0], item[1]) if item else (None, 0)
+
+    def cas(self, ns, key, expected_version, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            item = self._live((ns, key), now)
+            if (item[1] if item else 0) != expected_version:
+                return False
+            if value is None:
+                self.data.pop((ns, key), None)
+            else:
+                self.data[(ns, key)] = (value, expected_version + 1, now + ttl if ttl else None)
+            self._written(now)
+            return True
+
+    def add_if_absent(self, ns, key, value, ttl=None):
+        now = time.time()
+        with self.lock:
+            if self._live((ns, key), now):
+                return False
+            self.data[(ns, key)] = (value, 1, now + ttl if ttl else None)
+            self._written(now)
+            return True
+
+    def delete(self, ns, key):
+        with self.lock:
+            self.data.pop((ns, key), None)
+
+    def items(self, ns):
+        now = time.time()
+        with self.lock:
+            return [(k[1], self._live(k, now)[0]) for k in list(self.data) if k[0] == ns and self._live(k, now)]
+
+    def write_batch(self, ops):
+        with self.lock:
+            for op in ops:
+                if op[0] == "set":
+                    old = self.data.get((op[1], op[2]))
+                    self.data[(op[1], op[2])] = (op[3], (old[1] if old else 0) + 1, None)
+                else:
+                    self.data.pop((op[1], op[2]), None)
+
+    def count(self, ns):
+        return len(self.items(ns))
+
+class SQLiteBackend:
+    # 同機多 process：SQLite 檔案 + flock，寫入以 BEGIN IMMEDIATE 交易完成 compare-and-set
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.writes = 0
+        self.lock_file = open(f"{path}.lock", "a")
+        with self._write() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv ("
+                "ns TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, version INTEGER NOT NULL, expires REAL, "
+                "PRIMARY KEY (ns, key))"
+            )
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    class _Transaction:
+        def __init__(self, backend):
+            self.backend = backend
+
+        def __enter__(self):
+            # 任一步失敗時依相反順序釋放已取得的鎖，避免之後的寫入永遠卡住
+            self.backend.lock.acquire()
+            try:
+                fcntl.flock(self.backend.lock_file, fcntl.LOCK_EX)
+                try:
+                    self.conn = self.backend._conn()
+                    self.conn.execute("BEGIN IMMEDIATE")
+                except BaseException:
+                    fcntl.flock(self.backend.lock_file, fcntl.LOCK_UN)
+                    raise
+            except BaseException:
+                self.backend.lock.release()
+                raise
+            return self.conn
+
+        def __exit__(self, exc_type, exc, tb):
+            try:
+                self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+            finally:
+                fcntl.flock(self.backend.lock_file, fcntl.LOCK_UN)
+                self.backend.lock.release()
+
+    def _write(self):
+        return self._Transaction(self)
+
+    def _row(self, conn, ns, key):
+        row = conn.execute("SELECT value, version, expires FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        if row and row[2] is not None and row[2] < time.time():
+            return None
+        return row
+
+    def get(self, ns, key):
+        row = self._row(self._conn(), ns, key)
+        return (bytes(row[0]), row[1]) if row else (None, 0)
+
+    def cas(self, ns, key, expected_version, value, ttl=None):
+        with self._write() as conn:
+            row = self._row(conn, ns, key)
+            if (row[1] if row else 0) != expected_version:
+                return False
+            if value is None:
+                conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO kv (ns, key, value, version, expires) VALUES (?, ?, ?, ?, ?)",
+                    (ns, key, value, expected_version + 1, time.time() + ttl if ttl else None)
+                )
+            self.writes += 1
+            if self.writes % SQLITE_PURGE_EVERY == 0:
+                conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+            return True
+
+    def add_if_absent(self, ns, key, value, ttl=None):
+        with self._write() as conn:
+            if self._row(conn, ns, key):
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO kv (ns, key, value, version, expires) VALUES (?, ?, ?, 1, ?)",
+                (ns, key, value, time.time() + ttl if ttl else None)
+            )
+            return True
+
+    def delete(self, ns, key):
+        with self._write() as conn:
+            conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+
+    def items(self, ns):
+        rows = self._conn().execute(
+            "SELECT key, value FROM kv WHERE ns = ? AND (expires IS NULL OR expires >= ?)", (ns, time.time())
+        ).fetchall()
+        return [(k, bytes(v)) for k, v in rows]
+
+    def write_batch(self, ops):
+        with self._write() as conn:
+            for op in ops:
+                if op[0] == "set":
+                    conn.execute(
+                        "INSERT INTO kv (ns, key, value, version, expires) VALUES (?, ?, ?, 1, NULL) "
+                        "ON CONFLICT (ns, key) DO UPDATE SET value = excluded.value, version = kv.version + 1, expires = NULL",
+                        (op[1], op[2], op[3])
+                    )
+                else:
+                    conn.execute("DELETE FROM kv WHERE ns = ? AND key = ?", (op[1], op[2]))
+
+    def count(self, ns):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM kv WHERE ns = ? AND (expires IS NULL OR expires >= ?)", (ns, time.time())
+        ).fetchone()[0]
+
+    def purge_expired(self):
+        with self._write() as conn:
+            conn.execute("DELETE FROM kv WHERE expires IS NOT NULL AND expires < ?", (time.time(),))
+
+class RedisError(Exception):
+    pass
+
+class _RedisConnection:
+    # 最小化的 RESP2 client，只實作本專案用到的指令
+    def __init__(self, host, port, db, password=None):
+        self.sock = socket.create_connection((host, port), timeout=5)
+        self.reader = self.sock.makefile("rb")
+        if password:
+            self.execute("AUTH", password)
+        if db:
+            self.execute("SELECT", db)
+
+    def execute(self, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        self.sock.sendall(b"".join(parts))
+        return self._read()
+
+    def _read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("redis connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(rest.decode("utf-8"))
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = self.reader.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            if n < 0:
+                return None
+            return [self._read() for _ in range(n)]
+        raise RedisError(f"unexpected reply: {line!r}")
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+class RedisBackend:
+    # 值前綴版本號：b"<version>:<payload>"；compare-and-set 以 WATCH / MULTI / EXEC 完成
+    def __init__(self, url, prefix="line_exam:"):
+        self.url = url
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "127.0.0.1"
+        self.port = parsed.port or 6379
+        self.db = int((parsed.path or "/0").lstrip("/") or 0)
+        self.password = parsed.password
+        self.prefix = prefix
+        self.local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = _RedisConnection(self.host, self.port, self.db, self.password)
+        return conn
+
+    def _execute(self, *args):
+        try:
+            return self._conn().execute(*args)
+        except (OSError, ConnectionError):
+            # 連線中斷時重連一次
+            conn = getattr(self.local, "conn", None)
+            if conn:
+                conn.close()
+            self.local.conn = None
+            return self._conn().execute(*args)
+
+    def _key(self, ns, key):
+        return f"{self.prefix}{ns}:{key}"
+
+    @staticmethod
+    def _decode(raw):
+        if raw is None:
+            return None, 0
+        version, _, value = raw.partition(b":")
+        return value, int(version)
+
+    def get(self, ns, key):
+        return self._decode(self._execute("GET", self._key(ns, key)))
+
+    def cas(self, ns, key, expected_version, value, ttl=None):
+        k = self._key(ns, key)
+        conn = self._conn()
+        conn.execute("WATCH", k)
+        _, version = self._decode(conn.execute("GET", k))
+        if version != expected_version:
+            conn.execute("UNWATCH")
+            return False
+        conn.execute("MULTI")
+        if value is None:
+            conn.execute("DEL", k)
+        elif ttl:
+            conn.execute("SET", k, b"%d:" % (expected_version + 1) + value, "PX", int(ttl * 1000))
+        else:
+            conn.execute("SET", k, b"%d:" % (expected_version + 1) + value)
+        return conn.execute("EXEC") is not None
+
+    def add_if_absent(self, ns, key, value, ttl=None):
+        args = ["SET", self._key(ns, key), b"1:" + value, "NX"]
+        if ttl:
+            args += ["PX", int(ttl * 1000)]
+        return self._execute(*args) == "OK"
+
+    def delete(self, ns, key):
+        self._execute("DEL", self._key(ns, key))
+
+    def _scan(self, ns):
+        pattern = self._key(ns, "*")
+        cursor, keys = b"0", []
+        while True:
+            cursor, batch = self._execute("SCAN", cursor, "MATCH", pattern, "COUNT", 500)
+            keys.extend(batch)
+            if cursor in (b"0", "0", 0):
+                return keys
+
+    def items(self, ns):
+        keys = self._scan(ns)
+        if not keys:
+            return []
+        start = len(self._key(ns, ""))
+        values = self._execute("MGET", *keys)
+        return [(k[start:].decode("utf-8"), self._decode(v)[0]) for k, v in zip(keys, values) if v is not None]
+
+    def write_batch(self, ops):
+        conn = self._conn()
+        conn.execute("MULTI")
+        for op in ops:
+            if op[0] == "set":
+                conn.execute("SET", self._key(op[1], op[2]), b"1:" + op[3])
+            else:
+                conn.execute("DEL", self._key(op[1], op[2]))
+        conn.execute("EXEC")
+
+    def count(self, ns):
+        return len(self._scan(ns))
+
+def create_backend(spec=SHARED_STATE):
+    if spec.startswith("redis://"):
+        return RedisBackend(spec)
+    if spec.startswith("sqlite://"):
+        # sqlite:///state.db 為相對路徑，sqlite:////var/run/state.db 為絕對路徑
+        return SQLiteBackend(spec[len("sqlite:///"):] if spec.startswith("sqlite:///") else spec[len("sqlite://"):])
+    return InProcessBackend()
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
+
+def is_shared():
+    return SHARED_STATE != "memory"
+
+class SharedDict:
+    # 以後端存放的小型 dict（例如註冊暫存），介面與一般 dict 相同
+    def __init__(self, backend, ns, ttl=None):
+        self.backend = backend
+        self.ns = ns
+        self.ttl = ttl
+
+    def __contains__(self, key):
+        return self.backend.get(self.ns, key)[0] is not None
+
+    def get(self, key, default=None):
+        value = self.backend.get(self.ns, key)[0]
+        return value.decode("utf-8") if value is not None else default
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        while True:
+            _, version = self.backend.get(self.ns, key)
+            if self.backend.cas(self.ns, key, version, str(value).encode("utf-8"), self.ttl):
+                return
+
+    def __delitem__(self, key):
+        self.backend.delete(self.ns, key)
+
+    def __len__(self):
+        return self.backend.count(self.ns)
@@ -0,0 +1,78 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from bank_cache import get_question_bank
+
+class StartupTracker:
+    # 記錄每個啟動階段耗時，暖機完成後才回報 ready
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = OrderedDict()
+        self.ready = threading.Event()
+        self.error = None
+
+    @contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(time.perf_counter() - t, 3)
+
+    def mark_ready(self):
+        self.timings["total"] = round(time.perf_counter() - self.started, 3)
+        self.ready.set()
+        print("🚀 啟動完成：" + "、".join(f"{k} {v}s" for k, v in self.timings.items()))
+
+    def report(self):
+        return {"ready": self.ready.is_set(), "timings": dict(self.timings), "error": self.error}
+
+_openai_client = None
+_openai_lock = threading.Lock()
+
+def get_openai_client():
+    # 整個 process 共用一個 OpenAI client 與其 keep-alive 連線池
+    global _openai_client
+    with _openai_lock:
+        if _openai_client is None:
+            import httpx
+            from openai import OpenAI
+            _openai_client = OpenAI(
+                api_key=os.getenv("OPENAI_API_KEY"),
+                http_client=httpx.Client(
+                    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+                    timeout=httpx.Timeout(15.0, connect=5.0)
+                )
+            )
+        return _openai_client
+
+def preload_banks(repos):
+    # 並行載入所有科目題庫（有磁碟快照時直接讀快照並於背景重新驗證）
+    repos = list(repos)
+    with ThreadPoolExecutor(max_workers=max(1, len(repos))) as pool:
+        return dict(zip(repos, pool.map(lambda repo: len(get_question_bank(repo)), repos)))
+
+def warm_up(tracker, repos, extra_steps=()):
+    # 各階段互不影響：某一步失敗仍繼續其餘暖機
+    steps = [("openai_client", get_openai_client)] + list(extra_steps)
+    steps.append(("question_banks", lambda: preload_banks(repos)))
+    errors = []
+    for name, step in steps:
+        try:
+            with tracker.phase(name):
+                result = step()
+            if name == "question_banks":
+                empty = [repo for repo, n in result.items() if not n]
+                if empty:
+                    print(f"⚠️ 題庫預載失敗：{', '.join(empty)}")
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+            print(f"⚠️ 暖機失敗 {name}：{e}")
+    tracker.error = "; ".join(errors) or None
+    tracker.mark_ready()
+
+def start_warm_up(tracker, repos, extra_steps=()):
+    threading.Thread(target=warm_up, args=(tracker, repos, extra_steps), name="warm-up", daemon=True).start()
@@ -0,0 +1,107 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from llm_gateway import CircuitBreaker, GatewayRejected, LLMGateway, TokenBucket
+
+class FakeClient:
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, timeout=None, **request):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("openai down")
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" ok "))])
+
+class HeldLeaderGateway(LLMGateway):
+    # 帶頭的背景呼叫（max_wait=0）停在 _call 內，直到測試放行後才被拒絕
+    def __init__(self, **kwargs):
+        super(HeldLeaderGateway, self).__init__(**kwargs)
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def _call(self, client, max_wait, request, on_send=None):
+        if max_wait == 0:
+            self.entered.set()
+            self.release.wait(5)
+            self._reject("busy")
+        return super(HeldLeaderGateway, self)._call(client, max_wait, request, on_send)
+
+def test_follower_retries_when_leader_rejected_by_its_own_max_wait():
+    # 背景預先產生被拒絕時，合併進來的學生請求不應一起失敗
+    gateway = HeldLeaderGateway(bucket=TokenBucket(rate=100, capacity=10))
+    client = FakeClient()
+    results = {}
+
+    def prefetch():
+        try:
+            gateway.complete(client, max_wait=0, model="m", messages=["q"])
+        except GatewayRejected as e:
+            results["prefetch"] = e.reason
+
+    def student():
+        results["student"] = gateway.complete(client, model="m", messages=["q"])
+
+    leader = threading.Thread(target=prefetch)
+    leader.start()
+    assert gateway.entered.wait(5)
+    follower = threading.Thread(target=student)
+    follower.start()
+    while gateway.report()["coalesced"] == 0:
+        time.sleep(0.01)
+    gateway.release.set()
+    leader.join(5)
+    follower.join(5)
+    assert results == {"prefetch": "busy", "student": "ok"}
+    assert client.calls == 1
+
+def open_breaker(cooldown=0.05):
+    breaker = CircuitBreaker(window=4, min_calls=1, error_rate=0.5, cooldown=cooldown)
+    breaker.record(False)
+    assert breaker.state == "open"
+    time.sleep(cooldown * 2)
+    return breaker
+
+def test_probe_rejected_by_rate_limit_is_returned():
+    # 冷卻後的探測請求被限流拒絕時，斷路器不可卡在半開
+    bucket = TokenBucket(rate=1000, capacity=1)
+    bucket.tokens = 0
+    bucket.rate = 0.001
+    gateway = LLMGateway(bucket=bucket, breaker=open_breaker())
+    client = FakeClient()
+    with pytest.raises(GatewayRejected, match="rate_limited"):
+        gateway.complete(client, max_wait=0, model="m", messages=["q"])
+    assert gateway.breaker.state == "open"
+    bucket.rate, bucket.tokens = 1000, 1
+    assert gateway.complete(client, max_wait=0, model="m", messages=["q"]) == "ok"
+    assert gateway.breaker.state == "closed"
+
+def test_probe_rejected_by_full_slots_is_returned():
+    gateway = LLMGateway(bucket=TokenBucket(rate=1000, capacity=10), breaker=open_breaker(), max_inflight=1)
+    client = FakeClient()
+    gateway.slots.acquire()
+    with pytest.raises(GatewayRejected, match="busy"):
+        gateway.complete(client, max_wait=0, model="m", messages=["q"])
+    assert gateway.breaker.state == "open"
+    gateway.slots.release()
+    assert gateway.complete(client, max_wait=0, model="m", messages=["q"]) == "ok"
+    assert gateway.breaker.state == "closed"
+
+def test_probe_interrupted_reopens_breaker():
+    gateway = LLMGateway(bucket=TokenBucket(rate=1000, capacity=10), breaker=open_breaker())
+
+    class Interrupt(BaseException):
+        pass
+
+    def create(timeout=None, **request):
+        raise Interrupt()
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    with pytest.raises(Interrupt):
+        gateway.complete(client, model="m", messages=["q"])
+    assert gateway.breaker.state == "open"
@@ -0,0 +1,50 @@
+import pytest
+import registry
+from registry import Registry, SharedStore
+from shared_state import InProcessBackend
+
+@pytest.fixture(autouse=True)
+def sync_every_read(monkeypatch):
+    monkeypatch.setattr(registry, "REGISTRY_SYNC_INTERVAL", 0)
+
+def sqlite_pair(tmp_path):
+    path = str(tmp_path / "race.db")
+    return Registry(path), Registry(path)
+
+def shared_pair(tmp_path):
+    backend = InProcessBackend()
+    return Registry(store=SharedStore(backend)), Registry(store=SharedStore(backend))
+
+def interleave(a, b, when):
+    # 在 A 寫入的前或後插入 B 的寫入，模擬另一個 worker 同時寫入
+    apply = a.store.apply
+
+    def racing_apply(ops):
+        if when == "before":
+            b.put("pending", {"line_id": "UX", "student_id": "X1"})
+        result = apply(ops)
+        if when == "after":
+            b.put("pending", {"line_id": "UX", "student_id": "X1"})
+        return result
+
+    a.store.apply = racing_apply
+
+@pytest.mark.parametrize("pair", [sqlite_pair, shared_pair])
+@pytest.mark.parametrize("when", ["before", "after"])
+def test_concurrent_write_is_not_absorbed(tmp_path, pair, when):
+    a, b = pair(tmp_path)
+    interleave(a, b, when)
+    a.put("pending", {"line_id": "UA", "student_id": "A1"})
+    assert a.find("pending", "X1")["line_id"] == "UX"
+    assert a.find("pending", "A1")["line_id"] == "UA"
+    assert b.find("pending", "A1")["line_id"] == "UA"
+
+@pytest.mark.parametrize("pair", [sqlite_pair, shared_pair])
+def test_own_writes_do_not_reload(tmp_path, pair):
+    a, _ = pair(tmp_path)
+    reloads = []
+    a.subscribe(lambda ops: reloads.append(ops is None))
+    a.put("pending", {"line_id": "UA", "student_id": "A1"})
+    a.approve("A1")
+    assert a.find("whitelist", "A1")["line_id"] == "UA"
+    assert reloads == [False, False]
@@ -0,0 +1,35 @@
+import difflib
+import pytest
+from exam_logic import ALIAS, SUBJECTS
+from router import SubjectIndex
+
+def match_subject_name(input_name, alias, subjects):
+    # 改版前 exam_logic 的比對方式，作為對照
+    if input_name in alias:
+        input_name = alias[input_name]
+    best_match = difflib.get_close_matches(input_name, subjects.keys(), n=1, cutoff=0.4)
+    return best_match[0] if best_match else None
+
+def _inputs():
+    texts = set(ALIAS) | set(SUBJECTS)
+    for name in SUBJECTS:
+        for i in range(len(name)):
+            for j in range(i + 1, len(name) + 1):
+                texts.add(name[i:j])
+    texts |= {"生理", "血清", "臨床", "臨床學", "微生物學", "x", "免疫學測驗", "臨床" * 20}
+    return sorted(texts)
+
+INDEX = SubjectIndex(SUBJECTS, ALIAS)
+
+@pytest.mark.parametrize("text", _inputs())
+def test_subject_index_matches_difflib(text):
+    assert INDEX.match(text) == match_subject_name(text, ALIAS, SUBJECTS)
+
+@pytest.mark.parametrize("text, expected", [
+    ("生理", "臨床生理與病理學"),
+    ("血清", "臨床血清免疫學"),
+    ("免疫", "臨床血清免疫學"),
+    ("x", None),
+])
+def test_subject_index_examples(text, expected):
+    assert INDEX.match(text) == expected